@@ -0,0 +1,130 @@
+"""
+アドミッション制御（全体の同時実行数制限 + 待ち行列 + ユーザー単位のレート制限）
+"""
+import os
+import math
+import time
+import asyncio
+from typing import Dict
+from fastapi import HTTPException
+from cachetools import LRUCache
+
+ASK_MAX_CONCURRENT = int(os.getenv("ASK_MAX_CONCURRENT", 32))
+ASK_MAX_QUEUE = int(os.getenv("ASK_MAX_QUEUE", 64))
+ASK_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ASK_QUEUE_TIMEOUT_SECONDS", 5))
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", 60))  # 0で無効
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", 10))
+
+class TokenBucket:
+    """トークンバケット（rate: 1秒あたりの補充数、capacity: バースト上限）"""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """1トークン消費。成功時は0、不足時は次のトークンまでの秒数を返す"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class Permit:
+    """実行枠（releaseは何度呼んでも1回だけ有効）"""
+    __slots__ = ("_controller", "_released")
+
+    def __init__(self, controller: "AdmissionController"):
+        self._controller = controller
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release()
+
+class AdmissionController:
+    """同時実行数を超えた要求は待ち行列で期限付き待機し、溢れた分は即座に429/503で拒否"""
+    def __init__(
+        self,
+        max_concurrent: int = ASK_MAX_CONCURRENT,
+        max_queue: int = ASK_MAX_QUEUE,
+        queue_timeout: float = ASK_QUEUE_TIMEOUT_SECONDS,
+        rate_per_minute: float = RATE_LIMIT_PER_MINUTE,
+        burst: int = RATE_LIMIT_BURST
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._buckets = LRUCache(maxsize=int(os.getenv("RATE_LIMIT_USERS", 10000)))
+        self.active = 0
+        self.waiting = 0
+        self.counters = {
+            "admitted": 0,
+            "rejected_rate_limited": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0
+        }
+
+    def _check_rate(self, user_id: str):
+        if self.rate <= 0:
+            return
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[user_id] = bucket
+        wait = bucket.take()
+        if wait > 0:
+            self.counters["rejected_rate_limited"] += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Rate limit exceeded",
+                headers={"Retry-After": str(math.ceil(wait))}
+            )
+
+    def _overloaded(self, counter: str):
+        self.counters[counter] += 1
+        return HTTPException(
+            status_code=503,
+            detail="Server busy",
+            headers={"Retry-After": str(max(math.ceil(self.queue_timeout), 1))}
+        )
+
+    async def acquire(self, user_id: str) -> Permit:
+        """実行枠を取得（レート超過は429、待ち行列満杯・待機期限切れは503）"""
+        self._check_rate(user_id)
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            raise self._overloaded("rejected_queue_full")
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._overloaded("rejected_timeout")
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        self.counters["admitted"] += 1
+        return Permit(self)
+
+    def _release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self) -> Dict:
+        return {
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            **self.counters
+        }
@@ -2,34 +2,80 @@
 認証モジュール（DEMO/将来拡張用）
 """
 import os
+import time
+import hashlib
 from jose import jwt
 from jose.exceptions import ExpiredSignatureError, JWTError
 from typing import Optional
-from fastapi import HTTPException, Header
+from fastapi import HTTPException, Header, Depends
+from cachetools import LRUCache
 
 JWT_SECRET = os.getenv("JWT_SECRET", "demo-secret")
 AUTH_MODE = os.getenv("AUTH_MODE", "demo")
+# 管理用エンドポイント（/admin/*）を使えるuser_id（カンマ区切り、未設定なら誰も使えない）
+ADMIN_USER_IDS = {u.strip() for u in os.getenv("ADMIN_USER_IDS", "").split(",") if u.strip()}
+
+# 検証済みトークンのキャッシュ（キー: トークンのダイジェスト、値: (payload, exp)）
+_token_cache = LRUCache(maxsize=int(os.getenv("TOKEN_CACHE_SIZE", 10000)))
+
+def _token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def invalidate_token_cache():
+    """検証済みトークンキャッシュを全削除"""
+    _token_cache.clear()
+
+def rotate_secret(secret: str):
+    """JWT秘密鍵を差し替え（旧鍵で検証済みのトークンは無効化）"""
+    global JWT_SECRET
+    JWT_SECRET = secret
+    invalidate_token_cache()
+
+def create_token(payload: dict) -> str:
+    """JWT発行"""
+    return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
 
 def verify_token(token: str) -> dict:
-    """JWT検証"""
+    """JWT検証（検証済みトークンはexpまでキャッシュ）"""
+    digest = _token_digest(token)
+    cached = _token_cache.get(digest)
+    if cached is not None:
+        payload, exp = cached
+        if exp is None or exp > time.time():
+            return payload
+        _token_cache.pop(digest, None)
+        raise HTTPException(status_code=401, detail="Token expired")
+
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        return payload
     except ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-def get_current_user_id(authorization: Optional[str] = None) -> str:
-    """Authorizationヘッダーからuser_idを取得"""
+    exp = payload.get("exp")
+    _token_cache[digest] = (payload, float(exp) if exp is not None else None)
+    return payload
+
+async def get_current_user_id(authorization: Optional[str] = Header(None)) -> str:
+    """Authorizationヘッダーからuser_idを取得（FastAPI依存関係、1リクエスト1回解決）
+
+    ブロッキングI/Oがないため async にしてイベントループ上で実行する
+    （スレッドプールを経由せず、_token_cache も単一スレッドからのみ更新される）。
+    """
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization required")
-    
+
     if authorization.startswith("Bearer "):
         token = authorization[7:]
     else:
         token = authorization
-    
+
     payload = verify_token(token)
     return payload.get("user_id", "unknown")
 
+async def require_admin(user_id: str = Depends(get_current_user_id)) -> str:
+    """管理者のみ許可（FastAPI依存関係）"""
+    if user_id not in ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return user_id
@@ -0,0 +1,364 @@
+"""
+キャッシュバックエンド（メモリLRU / ローカルSQLite / Redisプロトコル）と2段キャッシュ
+"""
+import os
+import time
+import asyncio
+import socket
+import struct
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+import numpy as np
+from cachetools import LRUCache
+
+try:
+    from .chunk_store import ChunkStore, ChunkView
+except ImportError:
+    from chunk_store import ChunkStore, ChunkView
+
+# memory: プロセス内LRUのみ / sqlite: ローカルディスク / redis: レプリカ間で共有
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", 3600))
+CACHE_TIMEOUT_MS = int(os.getenv("CACHE_TIMEOUT_MS", 50))
+# SQLiteバックエンドの最大行数（超えた分は失効の近い順に削除）
+CACHE_MAX_ROWS = int(os.getenv("CACHE_MAX_ROWS", 100000))
+
+# --- シリアライズ（検索結果は行番号 + スコア、埋め込みは生のバイト列） ---
+
+_RESULTS = b"R"
+_VECTOR = b"V"
+
+def encode_value(value: Any) -> bytes:
+    if isinstance(value, np.ndarray):
+        vec = np.ascontiguousarray(value)
+        return _VECTOR + vec.dtype.char.encode() + vec.tobytes()
+    rows = np.array([doc.row for doc in value], dtype=np.int32)
+    scores = np.array([doc.score for doc in value], dtype=np.float32)
+    return _RESULTS + struct.pack("<I", len(rows)) + rows.tobytes() + scores.tobytes()
+
+def decode_value(data: bytes, store: ChunkStore) -> Any:
+    tag = data[:1]
+    if tag == _VECTOR:
+        return np.frombuffer(data[2:], dtype=np.dtype(data[1:2].decode())).copy()
+    if tag == _RESULTS:
+        (n,) = struct.unpack_from("<I", data, 1)
+        rows = np.frombuffer(data, dtype=np.int32, count=n, offset=5)
+        scores = np.frombuffer(data, dtype=np.float32, count=n, offset=5 + 4 * n)
+        return [ChunkView(store, int(row), float(score)) for row, score in zip(rows, scores)]
+    raise ValueError(f"Unknown cache value tag: {tag!r}")
+
+# --- 遠隔（far）バックエンド: bytes を保存 ---
+
+class SQLiteBackend:
+    """ローカルディスク上のSQLiteに保存（再起動後も残る）
+
+    PURGE_EVERY 回の書き込みごとに失効済みの行を削除し、max_rows を超えた分は失効の近い順に削除する。
+    """
+    name = "sqlite"
+    PURGE_EVERY = 100
+
+    def __init__(self, path: Path, ttl: int = CACHE_TTL_SECONDS, max_rows: int = CACHE_MAX_ROWS):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires_at REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_expires_at ON cache (expires_at)")
+        self.purge()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key])[0]
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        try:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({','.join('?' * len(keys))}) AND expires_at > ?",
+                    (*keys, time.time())
+                ).fetchall()
+        except sqlite3.Error:
+            return [None] * len(keys)
+        found = dict(rows)
+        return [found.get(key) for key in keys]
+
+    def set(self, key: str, value: bytes):
+        self.set_many([(key, value)])
+
+    def set_many(self, items: List[Tuple[str, bytes]]):
+        """1トランザクションでまとめて書き込み"""
+        expires_at = time.time() + self.ttl
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                        [(key, value, expires_at) for key, value in items]
+                    )
+                    self._conn.execute("COMMIT")
+                except sqlite3.Error:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                before = self._writes
+                self._writes += len(items)
+            if before // self.PURGE_EVERY != self._writes // self.PURGE_EVERY:
+                self.purge()
+        except sqlite3.Error:
+            pass
+
+    def purge(self):
+        """失効済みの行と上限超過分を削除"""
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+            if count > self.max_rows:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires_at LIMIT ?)",
+                    (count - self.max_rows,)
+                )
+
+class RedisBackend:
+    """Redisプロトコル（RESP）で GET / SET EX を行う最小クライアント
+
+    キャッシュ障害でリクエストを失敗させないよう、通信エラーはミス扱いにし、一定時間後に再接続する。
+    """
+    name = "redis"
+
+    def __init__(self, url: str, ttl: int = CACHE_TTL_SECONDS, timeout_ms: int = CACHE_TIMEOUT_MS):
+        parsed = urlparse(url or "redis://localhost:6379/0")
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.password = parsed.password
+        self.ttl = ttl
+        self.timeout = timeout_ms / 1000
+        self.errors = 0
+        self.retry_interval = 1.0
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._reader = None
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile("rb")
+        if self.password:
+            self._call("AUTH", self.password)
+        if self.db:
+            self._call("SELECT", str(self.db))
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._reader = None
+
+    @staticmethod
+    def _encode(*args) -> bytes:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _call(self, *args):
+        self._sock.sendall(self._encode(*args))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload
+        if kind == b"-":
+            raise RuntimeError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            return [self._read_reply() for _ in range(int(payload))]
+        raise RuntimeError(f"Unexpected reply: {line!r}")
+
+    def _pipeline(self, commands: List[tuple]) -> Optional[list]:
+        """複数コマンドをまとめて送信し、応答を順に読む（1往復）"""
+        with self._lock:
+            if time.monotonic() < self._down_until:
+                return None
+            try:
+                if self._sock is None:
+                    self._connect()
+                self._sock.sendall(b"".join(self._encode(*args) for args in commands))
+                return [self._read_reply() for _ in commands]
+            except (OSError, ConnectionError, RuntimeError):
+                self.errors += 1
+                self._close()
+                self._down_until = time.monotonic() + self.retry_interval
+                return None
+
+    def _command(self, *args):
+        replies = self._pipeline([args])
+        return replies[0] if replies is not None else None
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._command("GET", key)
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        values = self._command("MGET", *keys)
+        return values if isinstance(values, list) else [None] * len(keys)
+
+    def set(self, key: str, value: bytes):
+        self._command("SET", key, value, "EX", str(self.ttl))
+
+    def set_many(self, items: List[Tuple[str, bytes]]):
+        """SET EX をパイプラインでまとめて送信（MSET はTTLを指定できないため）"""
+        self._pipeline([("SET", key, value, "EX", str(self.ttl)) for key, value in items])
+
+def create_far_backend(default_path: Path):
+    """CACHE_BACKEND に応じた遠隔バックエンド（memory の場合はなし）"""
+    if CACHE_BACKEND == "sqlite":
+        # DATABASE_URL と同様に sqlite:/// を外す（sqlite:///./x は相対、sqlite:////x は絶対パス）
+        path = Path(CACHE_URL.replace("sqlite:///", "")) if CACHE_URL else default_path
+        return SQLiteBackend(path)
+    if CACHE_BACKEND == "redis":
+        return RedisBackend(CACHE_URL)
+    return None
+
+# --- 2段キャッシュ ---
+
+class TieredCache:
+    """近（プロセス内LRU、オブジェクトのまま）→ 遠（SQLite/Redis、バイト列）の順に参照
+
+    遠キャッシュのキーは namespace（コーパスのスナップショット識別子）で区切り、
+    文書が変わったときに古い行番号の結果を返さないようにする。
+    イベントループ上では aget / aget_many / acontains / aset / aset_many を使う（遠キャッシュの I/O はワーカースレッドで行い、
+    書き込みは完了を待たない）。get / [] / in は同期I/Oのためスクリプト等のループ外向け。
+    """
+    def __init__(
+        self,
+        maxsize: int,
+        far=None,
+        decode: Callable[[bytes], Any] = None,
+        namespace: str = ""
+    ):
+        self.near = LRUCache(maxsize=maxsize)
+        self.far = far
+        self.decode = decode
+        self.namespace = namespace
+        self.stats = {"near_hits": 0, "far_hits": 0, "misses": 0}
+        self._writes: Set[asyncio.Task] = set()
+
+    def _far_key(self, key: str) -> str:
+        return f"grag:{self.namespace}:{key}"
+
+    def get(self, key: str, default=None):
+        value = self.near.get(key)
+        if value is not None:
+            self.stats["near_hits"] += 1
+            return value
+        if self.far is not None:
+            data = self.far.get(self._far_key(key))
+            if data is not None:
+                value = self.decode(data)
+                self.near[key] = value
+                self.stats["far_hits"] += 1
+                return value
+        self.stats["misses"] += 1
+        return default
+
+    async def aget(self, key: str, default=None):
+        return (await self.aget_many([key], default))[0]
+
+    async def aget_many(self, keys: List[str], default=None) -> List[Any]:
+        """複数キーを取得（近キャッシュにないものは遠キャッシュへ1回でまとめて問い合わせ）"""
+        values = [self.near.get(key) for key in keys]
+        misses = [i for i, value in enumerate(values) if value is None]
+        self.stats["near_hits"] += len(keys) - len(misses)
+        if misses and self.far is not None:
+            found = await asyncio.to_thread(self.far.get_many, [self._far_key(keys[i]) for i in misses])
+            for i, data in zip(misses, found):
+                if data is not None:
+                    values[i] = self.decode(data)
+                    self.near[keys[i]] = values[i]
+                    self.stats["far_hits"] += 1
+        self.stats["misses"] += sum(1 for i in misses if values[i] is None)
+        return [default if value is None else value for value in values]
+
+    async def acontains(self, key: str) -> bool:
+        """遠キャッシュにあれば近キャッシュへ昇格させておく"""
+        if key in self.near:
+            return True
+        if self.far is None:
+            return False
+        data = await asyncio.to_thread(self.far.get, self._far_key(key))
+        if data is None:
+            return False
+        self.near[key] = self.decode(data)
+        return True
+
+    async def aset(self, key: str, value: Any):
+        await self.aset_many([(key, value)])
+
+    async def aset_many(self, items: List[Tuple[str, Any]]):
+        """近キャッシュへ即時保存し、遠キャッシュへはバックグラウンドで1回にまとめて書き込む"""
+        for key, value in items:
+            self.near[key] = value
+        if self.far is not None and items:
+            encoded = [(self._far_key(key), encode_value(value)) for key, value in items]
+            task = asyncio.create_task(asyncio.to_thread(self.far.set_many, encoded))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    def __contains__(self, key: str) -> bool:
+        if key in self.near:
+            return True
+        if self.far is None:
+            return False
+        # 遠キャッシュにあれば近キャッシュへ昇格させておく
+        data = self.far.get(self._far_key(key))
+        if data is None:
+            return False
+        self.near[key] = self.decode(data)
+        return True
+
+    def __getitem__(self, key: str):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        self.near[key] = value
+        if self.far is not None:
+            self.far.set(self._far_key(key), encode_value(value))
+
+    def __len__(self) -> int:
+        return len(self.near)
+
+    def clear(self):
+        """近キャッシュのみ削除（遠キャッシュは他レプリカと共有のためTTLで失効）"""
+        self.near.clear()
+
+    def info(self) -> Dict:
+        return {
+            "backend": self.far.name if self.far is not None else "memory",
+            "near_size": len(self.near),
+            "near_maxsize": self.near.maxsize,
+            **self.stats
+        }
@@ -0,0 +1,166 @@
+"""
+列指向チャンクストア（文書表 + 整数doc id + 単一テキストバッファへのオフセット）
+"""
+import os
+import json
+import mmap
+from pathlib import Path
+from typing import Callable, Dict, List
+import numpy as np
+
+def _write_replacing(path: Path, write: Callable):
+    """一時ファイルに書いてから os.replace で差し替え（mmap 中の既存ファイルを切り詰めない）"""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+class ChunkView:
+    """検索結果の軽量ビュー（本文等はアクセス時にストアから取り出す）"""
+    __slots__ = ("store", "row", "score")
+
+    def __init__(self, store: "ChunkStore", row: int, score: float = 0.0):
+        self.store = store
+        self.row = row
+        self.score = score
+
+    @property
+    def id(self) -> str:
+        return self.store.chunk_id(self.row)
+
+    @property
+    def doc_id(self) -> str:
+        return self.store.doc_ids[self.store.doc_index[self.row]]
+
+    @property
+    def title(self) -> str:
+        return self.store.titles[self.store.doc_index[self.row]]
+
+    @property
+    def text(self) -> str:
+        return self.store.text(self.row)
+
+    def with_score(self, score: float) -> "ChunkView":
+        return ChunkView(self.store, self.row, score)
+
+    def to_dict(self, snippet_chars: int = 150) -> Dict:
+        """APIレスポンス（Citation）用に実体化"""
+        return {
+            "id": self.id,
+            "title": self.title,
+            "snippet": self.text[:snippet_chars] + "...",
+            "score": self.score
+        }
+
+class ChunkStore:
+    """チャンクを列ごとに保持するストア
+
+    - doc_ids / titles: 文書表（文書ごとに1回だけ保持）
+    - doc_index: チャンク → 文書番号（int32）
+    - positions: 文書内の単語位置（int32、チャンクIDの生成に使用）
+    - offsets: UTF-8テキストバッファ上の開始位置（int64、末尾に終端を含む）
+    - buffer: 全チャンク本文を連結したバイト列（スナップショットからは mmap）
+    """
+    def __init__(
+        self,
+        doc_ids: List[str],
+        titles: List[str],
+        doc_index: np.ndarray,
+        positions: np.ndarray,
+        offsets: np.ndarray,
+        buffer
+    ):
+        self.doc_ids = doc_ids
+        self.titles = titles
+        self.doc_index = doc_index
+        self.positions = positions
+        self.offsets = offsets
+        self.buffer = buffer
+
+    def __len__(self) -> int:
+        return len(self.doc_index)
+
+    @property
+    def nbytes(self) -> int:
+        """常駐メモリの概算（mmapのテキストバッファを含む）"""
+        table = sum(len(d) + len(t) for d, t in zip(self.doc_ids, self.titles))
+        return table + self.doc_index.nbytes + self.positions.nbytes + self.offsets.nbytes + len(self.buffer)
+
+    def chunk_id(self, row: int) -> str:
+        return f"{self.doc_ids[self.doc_index[row]]}_chunk_{self.positions[row]}"
+
+    def text(self, row: int) -> str:
+        return bytes(self.buffer[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    def view(self, row: int, score: float = 0.0) -> ChunkView:
+        return ChunkView(self, int(row), score)
+
+    def rows_for_docs(self, doc_numbers: List[int]) -> np.ndarray:
+        """指定文書番号に属するチャンクの行マスク"""
+        return np.isin(self.doc_index, doc_numbers)
+
+    def save(self, directory: Path):
+        """スナップショットへ保存（通常は RAGSystem が一時ディレクトリに書き出してから付け替える）
+
+        既存ファイルは他プロセスが mmap している可能性があるため、上書きせず1ファイルずつ差し替える。
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        docs = json.dumps({"doc_ids": self.doc_ids, "titles": self.titles}, ensure_ascii=False).encode("utf-8")
+        _write_replacing(directory / "docs.json", lambda f: f.write(docs))
+        _write_replacing(directory / "doc_index.npy", lambda f: np.save(f, self.doc_index))
+        _write_replacing(directory / "positions.npy", lambda f: np.save(f, self.positions))
+        _write_replacing(directory / "offsets.npy", lambda f: np.save(f, self.offsets))
+        _write_replacing(directory / "text.bin", lambda f: f.write(bytes(self.buffer)))
+
+    @classmethod
+    def load(cls, directory: Path) -> "ChunkStore":
+        """スナップショットから読み込み（列は mmap、テキストバッファも mmap）"""
+        docs = json.loads((directory / "docs.json").read_text(encoding="utf-8"))
+        buffer = b""
+        with open(directory / "text.bin", "rb") as f:
+            if (directory / "text.bin").stat().st_size > 0:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(
+            doc_ids=docs["doc_ids"],
+            titles=docs["titles"],
+            doc_index=np.load(directory / "doc_index.npy", mmap_mode="r"),
+            positions=np.load(directory / "positions.npy", mmap_mode="r"),
+            offsets=np.load(directory / "offsets.npy", mmap_mode="r"),
+            buffer=buffer
+        )
+
+class ChunkStoreBuilder:
+    """ChunkStoreを取り込み時に組み立てる"""
+    def __init__(self):
+        self.doc_ids: List[str] = []
+        self.titles: List[str] = []
+        self._doc_index: List[int] = []
+        self._positions: List[int] = []
+        self._offsets: List[int] = [0]
+        self._buffer = bytearray()
+
+    def add_document(self, doc_id: str, title: str) -> int:
+        """文書を登録し文書番号を返す"""
+        self.doc_ids.append(doc_id)
+        self.titles.append(title)
+        return len(self.doc_ids) - 1
+
+    def add_chunk(self, doc_number: int, position: int, text: str):
+        self._doc_index.append(doc_number)
+        self._positions.append(position)
+        self._buffer.extend(text.encode("utf-8"))
+        self._offsets.append(len(self._buffer))
+
+    def build(self) -> ChunkStore:
+        return ChunkStore(
+            doc_ids=self.doc_ids,
+            titles=self.titles,
+            doc_index=np.array(self._doc_index, dtype=np.int32),
+            positions=np.array(self._positions, dtype=np.int32),
+            offsets=np.array(self._offsets, dtype=np.int64),
+            buffer=bytes(self._buffer)
+        )
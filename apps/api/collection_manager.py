@@ -0,0 +1,83 @@
+"""
+コレクション管理（名前付き知識ベースの遅延ロードとLRU退避）
+"""
+import os
+import re
+import asyncio
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+try:
+    from .rag import RAGSystem, DATA_DIR, INDEX_DIR
+except ImportError:
+    from rag import RAGSystem, DATA_DIR, INDEX_DIR
+
+DEFAULT_COLLECTION = "default"
+# コレクションごとの文書ディレクトリ: COLLECTIONS_DIR/<name>/*.md
+COLLECTIONS_DIR = Path(os.getenv("COLLECTIONS_DIR", DATA_DIR / "collections"))
+COLLECTION_MEMORY_MB = int(os.getenv("COLLECTION_MEMORY_MB", 1024))
+
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+class CollectionManager:
+    """コレクションを初回利用時にスナップショットから読み込み、メモリ予算超過時は古いものから退避
+
+    default コレクションは起動時に読み込み、退避対象にしない。
+    """
+    def __init__(self, default: RAGSystem, memory_budget_bytes: int = COLLECTION_MEMORY_MB * 1024 * 1024):
+        self.default = default
+        self.memory_budget_bytes = memory_budget_bytes
+        self.loaded: "OrderedDict[str, RAGSystem]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.evictions = 0
+
+    def names(self) -> List[str]:
+        """利用可能なコレクション名"""
+        names = [DEFAULT_COLLECTION]
+        if COLLECTIONS_DIR.exists():
+            names.extend(sorted(p.name for p in COLLECTIONS_DIR.iterdir() if p.is_dir() and _NAME_PATTERN.match(p.name)))
+        return names
+
+    async def get(self, name: Optional[str] = None) -> RAGSystem:
+        """コレクション取得（未ロードなら読み込み）。存在しない場合はKeyError"""
+        if not name or name == DEFAULT_COLLECTION:
+            return self.default
+
+        rag = self.loaded.get(name)
+        if rag is not None:
+            self.loaded.move_to_end(name)
+            return rag
+
+        if not _NAME_PATTERN.match(name) or not (COLLECTIONS_DIR / name).is_dir():
+            raise KeyError(name)
+
+        # 同一コレクションの同時初回ロードは1回にまとめる
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            rag = self.loaded.get(name)
+            if rag is None:
+                rag = RAGSystem(data_dir=COLLECTIONS_DIR / name, index_dir=INDEX_DIR / "collections" / name)
+                await rag.initialize()
+                self.loaded[name] = rag
+                self._evict()
+            else:
+                self.loaded.move_to_end(name)
+        return rag
+
+    def memory_bytes(self) -> int:
+        return self.default.memory_bytes() + sum(rag.memory_bytes() for rag in self.loaded.values())
+
+    def _evict(self):
+        """メモリ予算を超えている間、最も長く使われていないコレクションを退避（直近ロード分は残す）"""
+        while len(self.loaded) > 1 and self.memory_bytes() > self.memory_budget_bytes:
+            self.loaded.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        return {
+            "loaded": list(self.loaded),
+            "memory_bytes": self.memory_bytes(),
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "evictions": self.evictions
+        }
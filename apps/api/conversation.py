@@ -0,0 +1,128 @@
+"""
+会話セッションの状態（直近のターン・要約・取得済みチャンク）をメモリ上に保持
+"""
+import os
+import re
+import json
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+import numpy as np
+from cachetools import LRUCache
+
+SESSION_STORE_SIZE = int(os.getenv("SESSION_STORE_SIZE", 1000))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", 3))  # 要約せずプロンプトに載せるターン数
+SESSION_SUMMARY_CHARS = int(os.getenv("SESSION_SUMMARY_CHARS", 600))
+SESSION_MAX_CHUNKS = int(os.getenv("SESSION_MAX_CHUNKS", 32))
+
+TURN_ANSWER_CHARS = 200
+SUMMARY_SENTENCE_CHARS = 100
+
+# 和文の句点は直後で、欧文の終止符は後ろに空白がある場合のみ文末とみなす
+_SENTENCE_END = re.compile(r"(?<=[。．！？])|(?<=[.!?])\s")
+
+def _compact(text: str, limit: int = TURN_ANSWER_CHARS) -> str:
+    """空白を詰めて先頭limit文字に切り詰め"""
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+def _first_sentence(text: str) -> str:
+    """最初の1文（長すぎる場合は SUMMARY_SENTENCE_CHARS 文字で切り詰め）"""
+    text = " ".join(text.split())
+    sentence = _SENTENCE_END.split(text, maxsplit=1)[0].strip()
+    return _compact(sentence, SUMMARY_SENTENCE_CHARS)
+
+def extractive_summary(previous: str, turns: List[Tuple[str, str]], limit: int = SESSION_SUMMARY_CHARS) -> str:
+    """LLMなしの要約: ターンごとに「質問 → 回答の最初の1文」を1行にし、上限を超えたら古い行から捨てる"""
+    lines = [line for line in previous.split("\n") if line]
+    lines += [f"{question} → {_first_sentence(answer)}" for question, answer in turns]
+    while len(lines) > 1 and len("\n".join(lines)) > limit:
+        lines.pop(0)
+    return "\n".join(lines)
+
+class Conversation:
+    """1セッション分の状態
+
+    turns から溢れた古いターンは pending に移し、fold で summary（LLM要約または抽出的要約）に畳み込む。
+    rows/vectors は取得済みチャンクの行番号と正規化済み埋め込み（古いものから捨てる）。
+    """
+    def __init__(self, max_turns: int = SESSION_MAX_TURNS, max_chunks: int = SESSION_MAX_CHUNKS):
+        self.max_turns = max_turns
+        self.max_chunks = max_chunks
+        self.turns: Deque[Tuple[str, str]] = deque()
+        self.pending: List[Tuple[str, str]] = []  # 要約待ちのターン
+        self.summary = ""
+        self.summarizing = False  # LLM要約の実行中
+        self.scope: Optional[str] = None
+        self.rows = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+
+    def add_turn(self, question: str, answer: str):
+        self.turns.append((_compact(question), _compact(answer)))
+        while len(self.turns) > self.max_turns:
+            self.pending.append(self.turns.popleft())
+
+    def fold(self, summary: Optional[str] = None, count: Optional[int] = None):
+        """pending の先頭 count ターン（未指定時は全て）を要約に畳み込む（summary 未指定時は抽出的要約）"""
+        count = len(self.pending) if count is None else count
+        if summary is None:
+            summary = extractive_summary(self.summary, self.pending[:count])
+        self.summary = summary
+        del self.pending[:count]
+
+    def history(self) -> str:
+        """プロンプト用の簡潔な会話履歴（要約 + 要約待ち・直近のターン）"""
+        lines = [f"以前の会話の要約:\n{self.summary}"] if self.summary else []
+        for q, a in [*self.pending, *self.turns]:
+            lines += [f"Q: {q}", f"A: {a}"]
+        return "\n".join(lines)
+
+    def bind(self, namespace: str, filters: Optional[Dict[str, List[str]]] = None):
+        """検索対象（コーパスのスナップショット + フィルタ）が変わったら取得済みチャンクを破棄"""
+        canonical = json.dumps({f: sorted(v) for f, v in (filters or {}).items()}, sort_keys=True)
+        scope = f"{namespace}:{canonical}"
+        if scope != self.scope:
+            self.scope = scope
+            self.rows = np.empty(0, dtype=np.int64)
+            self.vectors = np.empty((0, 0), dtype=np.float32)
+
+    def merged(self, rows: np.ndarray, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """取得済みチャンクに rows を加えた候補（既出の行は除く。状態は変更しない）"""
+        new = ~np.isin(rows, self.rows)
+        if not len(self.rows):
+            return rows[new], vectors[new]
+        return np.concatenate([self.rows, rows[new]]), np.concatenate([self.vectors, vectors[new]])
+
+    def extend(self, rows: np.ndarray, vectors: np.ndarray):
+        """新たに取得したチャンクを追加（古いものから捨てる）"""
+        rows, vectors = self.merged(rows, vectors)
+        self.rows = rows[-self.max_chunks:]
+        self.vectors = vectors[-self.max_chunks:]
+
+class ConversationStore:
+    """セッションIDごとの Conversation を件数上限付きLRUで保持"""
+    def __init__(self, maxsize: int = SESSION_STORE_SIZE):
+        self._sessions: LRUCache = LRUCache(maxsize=maxsize)
+        self.counters = {"hits": 0, "restored": 0}
+
+    def get(
+        self,
+        session_id: int,
+        load_turns: Optional[Callable[[], List[Tuple[str, str]]]] = None
+    ) -> Conversation:
+        """取得（なければ作成し、load_turns があればDBの直近ターンから履歴を復元）"""
+        conversation = self._sessions.get(session_id)
+        if conversation is not None:
+            self.counters["hits"] += 1
+            return conversation
+        conversation = Conversation()
+        if load_turns is not None:
+            for question, answer in load_turns():
+                conversation.add_turn(question, answer)
+            conversation.fold()
+            if conversation.turns:
+                self.counters["restored"] += 1
+        self._sessions[session_id] = conversation
+        return conversation
+
+    def stats(self) -> Dict:
+        return {"size": len(self._sessions), "maxsize": self._sessions.maxsize, **self.counters}
@@ -26,6 +26,10 @@ def init_db():
     """
     # モデルがインポートされていることを確認するため、Base.metadata にテーブルが登録されているかチェック
     Base.metadata.create_all(bind=engine)
+    # 既存テーブルには create_all がインデックスを追加しないため個別に作成
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
 def get_db():
     """DBセッション取得"""
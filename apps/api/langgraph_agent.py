@@ -4,17 +4,20 @@ LangGraph Agent実装
 import time
 import json
 import asyncio
-from typing import Dict, Any, List, Optional, AsyncIterator
+from typing import Dict, Any, List, Optional, AsyncIterator, Tuple
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_openai import ChatOpenAI
 from rag import RAGSystem
+from chunk_store import ChunkView
+from conversation import Conversation, SESSION_SUMMARY_CHARS
 
 class LangGraphState:
     """LangGraphの状態定義"""
     def __init__(self):
         self.question: str = ""
         self.intent: Optional[str] = None
-        self.retrieved_docs: List[Dict] = []
+        self.retrieved_docs: List[ChunkView] = []
+        self.history: str = ""  # 同一セッションの直近の会話（要約含む）
         self.answer: str = ""
         self.citations: List[Dict] = []
         self.metrics: Dict[str, Any] = {}
@@ -25,6 +28,7 @@ class LangGraphAgent:
     def __init__(self, rag_system: RAGSystem):
         self.rag = rag_system
         self.llm = None
+        self._background: set = set()
         self._init_llm()
     
     def _init_llm(self):
@@ -38,6 +42,50 @@ class LangGraphAgent:
                 self.llm = None
         # DEMOモードではLLMなし（テンプレート回答）
     
+    def _prompt(self, state: LangGraphState) -> str:
+        """LLMへのプロンプト（会話履歴があれば先頭に付与）"""
+        context = "\n\n".join([f"[{i+1}] {doc.text}" for i, doc in enumerate(state.retrieved_docs)])
+        history = f"これまでの会話:\n{state.history}\n\n" if state.history else ""
+        return f"""{history}質問: {state.question}
+
+参考文書:
+{context}
+
+上記の参考文書に基づいて回答してください。引用は[1][2]の形式で示してください。"""
+    
+    def _update_summary(self, conversation: Conversation):
+        """要約待ちのターンを要約に畳み込む（DEMOは即時に抽出的要約、LLMありは応答を遅らせないよう裏で実行）"""
+        if not conversation.pending or conversation.summarizing:
+            return
+        if not self.llm:
+            conversation.fold()
+            return
+        task = asyncio.create_task(self._summarize(conversation))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+    
+    async def _summarize(self, conversation: Conversation):
+        """LLMで要約（失敗時は抽出的要約）"""
+        conversation.summarizing = True
+        turns = list(conversation.pending)
+        summary = None
+        try:
+            transcript = "\n".join(f"Q: {q}\nA: {a}" for q, a in turns)
+            messages = [HumanMessage(content=f"""これまでの要約:
+{conversation.summary or "（なし）"}
+
+追加の会話:
+{transcript}
+
+後続の質問に答えるための文脈として、上記を{SESSION_SUMMARY_CHARS}文字以内で要約してください。""")]
+            reply = await self.llm.ainvoke(messages)
+            summary = reply.content.strip() or None
+        except Exception as e:
+            print(f"Conversation summary failed: {e}")
+        finally:
+            conversation.fold(summary, count=len(turns))
+            conversation.summarizing = False
+    
     async def classify_intent(self, state: LangGraphState) -> LangGraphState:
         """意図分類"""
         start = time.time()
@@ -68,19 +116,56 @@ class LangGraphAgent:
             })
         return state
     
-    async def retrieve(self, state: LangGraphState, top_k: int = 4, use_rerank: bool = False) -> LangGraphState:
-        """検索実行"""
+    async def retrieve(
+        self,
+        state: LangGraphState,
+        top_k: int = 4,
+        use_rerank: bool = False,
+        filters: Optional[Dict[str, List[str]]] = None,
+        rag: Optional[RAGSystem] = None,
+        conversation: Optional[Conversation] = None
+    ) -> LangGraphState:
+        """検索実行（rag未指定時はデフォルトコレクション）
+
+        conversation 指定時も全体検索（キャッシュ済みなら再計算なし）は必ず行い、
+        その結果とセッションで取得済みのチャンクを合わせた候補から上位top_k件を選び直す。
+        """
         start = time.time()
         try:
-            docs = await self.rag.retrieve(state.question, top_k=top_k, use_rerank=use_rerank)
+            rag = rag if rag is not None else self.rag
+            trace: Dict[str, Any] = {}
+            cache_hit = await rag.is_cached(state.question, top_k=top_k, use_rerank=use_rerank, filters=filters)
+            docs = await rag.retrieve(
+                state.question, top_k=top_k, use_rerank=use_rerank, filters=filters, trace=trace
+            )
+            session_docs = 0
+            if conversation is not None:
+                conversation.bind(rag.cache.namespace, filters)
+                if docs:
+                    rows, vectors = rag.chunk_vectors(docs)
+                    if len(conversation.rows):
+                        docs = await rag.retrieve_within(
+                            state.question, *conversation.merged(rows, vectors),
+                            top_k=top_k, use_rerank=use_rerank
+                        )
+                        index_rows = set(rows.tolist())
+                        session_docs = sum(doc.row not in index_rows for doc in docs)
+                    conversation.extend(rows, vectors)
             state.retrieved_docs = docs
             elapsed = (time.time() - start) * 1000
-            state.node_history.append({
+            entry = {
                 "node": "retrieve",
                 "status": "success",
                 "elapsed_ms": elapsed,
-                "doc_count": len(docs)
-            })
+                "doc_count": len(docs),
+                "cache_hit": cache_hit
+            }
+            if conversation is not None:
+                entry["session_docs"] = session_docs  # 全体検索の結果になく、セッションの取得済みチャンクから選ばれた件数
+                entry["session_chunks"] = len(conversation.rows)
+            if trace:
+                entry["adaptive"] = trace
+            state.node_history.append(entry)
         except Exception as e:
             state.node_history.append({
                 "node": "retrieve",
@@ -93,18 +178,11 @@ class LangGraphAgent:
         """回答生成"""
         start = time.time()
         try:
-            context = "\n\n".join([f"[{i+1}] {doc['text']}" for i, doc in enumerate(state.retrieved_docs)])
+            context = "\n\n".join([f"[{i+1}] {doc.text}" for i, doc in enumerate(state.retrieved_docs)])
             
             if self.llm:
                 # REAL: LLM使用
-                messages = [
-                    HumanMessage(content=f"""質問: {state.question}
-
-参考文書:
-{context}
-
-上記の参考文書に基づいて回答してください。引用は[1][2]の形式で示してください。""")
-                ]
+                messages = [HumanMessage(content=self._prompt(state))]
                 answer = ""
                 async for chunk in self.llm.astream(messages):
                     if chunk.content:
@@ -120,15 +198,7 @@ class LangGraphAgent:
 （DEMOモード: 実際のLLM回答ではありません）"""
             
             # Citations作成
-            state.citations = [
-                {
-                    "id": doc["id"],
-                    "title": doc["title"],
-                    "snippet": doc["text"][:150] + "...",
-                    "score": doc.get("score", 0.0)
-                }
-                for doc in state.retrieved_docs
-            ]
+            state.citations = [doc.to_dict() for doc in state.retrieved_docs]
             
             elapsed = (time.time() - start) * 1000
             state.node_history.append({
@@ -155,7 +225,7 @@ class LangGraphAgent:
             "total_elapsed_ms": total_time,
             "node_count": len(state.node_history),
             "retrieved_docs": len(state.retrieved_docs),
-            "cache_hit": False,  # TODO: 実装
+            "cache_hit": any(n.get("cache_hit") for n in state.node_history if n["node"] == "retrieve"),
             "est_tokens": len(state.answer.split()) * 1.3,  # 簡易見積
             "node_history": state.node_history
         }
@@ -165,16 +235,26 @@ class LangGraphAgent:
         self,
         question: str,
         use_rerank: bool = True,
-        top_k: int = 4
+        top_k: int = 4,
+        filters: Optional[Dict[str, List[str]]] = None,
+        rag: Optional[RAGSystem] = None,
+        conversation: Optional[Conversation] = None
     ) -> Dict[str, Any]:
         """実行（非ストリーミング）"""
         state = LangGraphState()
         state.question = question
+        if conversation is not None:
+            state.history = conversation.history()
         
         state = await self.classify_intent(state)
-        state = await self.retrieve(state, top_k=top_k, use_rerank=use_rerank)
+        state = await self.retrieve(
+            state, top_k=top_k, use_rerank=use_rerank, filters=filters, rag=rag, conversation=conversation
+        )
         state = await self.generate(state)
         state = await self.finalize(state)
+        if conversation is not None:
+            conversation.add_turn(question, state.answer)
+            self._update_summary(conversation)
         
         return {
             "answer": state.answer,
@@ -182,35 +262,88 @@ class LangGraphAgent:
             "metrics": state.metrics
         }
     
+    async def run_batch(
+        self,
+        questions: List[str],
+        use_rerank: bool = True,
+        top_k: int = 4,
+        concurrency: int = 8,
+        filters: Optional[Dict[str, List[str]]] = None,
+        rag: Optional[RAGSystem] = None
+    ) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """一括実行（検索は一括、生成は並列度制限付き）。完了順に (index, 結果) を返す"""
+        if not questions:
+            return
+        
+        start = time.time()
+        rag = rag if rag is not None else self.rag
+        docs_list = await rag.retrieve_batch(questions, top_k=top_k, use_rerank=use_rerank, filters=filters)
+        # 一括検索の時間は質問数で按分して各ノード履歴に記録
+        retrieve_ms = (time.time() - start) * 1000 / len(questions)
+        
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        
+        async def answer(index: int, question: str, docs: List[ChunkView]) -> Tuple[int, Dict[str, Any]]:
+            async with semaphore:
+                state = LangGraphState()
+                state.question = question
+                state = await self.classify_intent(state)
+                state.retrieved_docs = docs
+                state.node_history.append({
+                    "node": "retrieve",
+                    "status": "success",
+                    "elapsed_ms": retrieve_ms,
+                    "doc_count": len(docs),
+                    "batched": True
+                })
+                state = await self.generate(state)
+                state = await self.finalize(state)
+                return index, {
+                    "answer": state.answer,
+                    "citations": state.citations,
+                    "metrics": state.metrics
+                }
+        
+        tasks = [
+            asyncio.create_task(answer(i, q, docs))
+            for i, (q, docs) in enumerate(zip(questions, docs_list))
+        ]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            # クライアント切断時は未完了の生成を中止
+            for task in tasks:
+                task.cancel()
+    
     async def run_stream(
         self,
         question: str,
         use_rerank: bool = True,
-        top_k: int = 4
+        top_k: int = 4,
+        filters: Optional[Dict[str, List[str]]] = None,
+        rag: Optional[RAGSystem] = None,
+        conversation: Optional[Conversation] = None
     ) -> AsyncIterator[Dict[str, Any]]:
         """実行（ストリーミング）"""
         state = LangGraphState()
         state.question = question
+        if conversation is not None:
+            state.history = conversation.history()
         
         # classify
         state = await self.classify_intent(state)
         yield {"type": "node", "data": {"node": "classify_intent", "status": "done"}}
         
         # retrieve
-        state = await self.retrieve(state, top_k=top_k, use_rerank=use_rerank)
+        state = await self.retrieve(
+            state, top_k=top_k, use_rerank=use_rerank, filters=filters, rag=rag, conversation=conversation
+        )
         yield {"type": "node", "data": {"node": "retrieve", "status": "done"}}
         
         # generate (streaming)
         if self.llm:
-            context = "\n\n".join([f"[{i+1}] {doc['text']}" for i, doc in enumerate(state.retrieved_docs)])
-            messages = [
-                HumanMessage(content=f"""質問: {state.question}
-
-参考文書:
-{context}
-
-上記の参考文書に基づいて回答してください。引用は[1][2]の形式で示してください。""")
-            ]
+            messages = [HumanMessage(content=self._prompt(state))]
             answer = ""
             async for chunk in self.llm.astream(messages):
                 if chunk.content:
@@ -226,18 +359,13 @@ class LangGraphAgent:
             state.answer = demo_answer
         
         # citations
-        state.citations = [
-            {
-                "id": doc["id"],
-                "title": doc["title"],
-                "snippet": doc["text"][:150] + "...",
-                "score": doc.get("score", 0.0)
-            }
-            for doc in state.retrieved_docs
-        ]
+        state.citations = [doc.to_dict() for doc in state.retrieved_docs]
         
         # finalize
         state = await self.finalize(state)
+        if conversation is not None:
+            conversation.add_turn(question, state.answer)
+            self._update_summary(conversation)
         
         yield {
             "type": "done",
@@ -3,48 +3,69 @@ G-RAG API Server
 FastAPI + LangGraph + RAG
 """
 import os
+import json
 import time
+import asyncio
 import hashlib
 from typing import List, Optional, Dict, Any
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from sse_starlette.sse import EventSourceResponse
-from pydantic import BaseModel
-from sqlalchemy import Column, Integer, String, Text, DateTime, Float
+from pydantic import BaseModel, Field
+from sqlalchemy import Column, Integer, String, Text, DateTime, Float, Index, func
 from sqlalchemy.orm import Session
-from datetime import datetime
-from jose import jwt
+from datetime import datetime, timedelta
 
 try:
     from .langgraph_agent import LangGraphAgent
-    from .rag import RAGSystem
-    from .auth import verify_token, get_current_user_id
-    from .database import get_db, init_db, Base
+    from .rag import RAGSystem, FILTER_FIELDS
+    from .collection_manager import CollectionManager
+    from .admission import AdmissionController
+    from .prefetch import Prefetcher
+    from .conversation import ConversationStore, SESSION_MAX_TURNS
+    from .pagination import keyset_page
+    from .warmup import CacheWarmer, WARMUP_QUESTIONS, WARMUP_DAYS
+    from .profiler import SamplingProfiler, AllocationTracker, PROFILE_INTERVAL_MS, TRACEMALLOC_FRAMES
+    from .auth import create_token, get_current_user_id, require_admin
+    from .database import get_db, init_db, Base, SessionLocal
 except ImportError:
     from langgraph_agent import LangGraphAgent
-    from rag import RAGSystem
-    from auth import verify_token, get_current_user_id
-    from database import get_db, init_db, Base
+    from rag import RAGSystem, FILTER_FIELDS
+    from collection_manager import CollectionManager
+    from admission import AdmissionController
+    from prefetch import Prefetcher
+    from conversation import ConversationStore, SESSION_MAX_TURNS
+    from pagination import keyset_page
+    from warmup import CacheWarmer, WARMUP_QUESTIONS, WARMUP_DAYS
+    from profiler import SamplingProfiler, AllocationTracker, PROFILE_INTERVAL_MS, TRACEMALLOC_FRAMES
+    from auth import create_token, get_current_user_id, require_admin
+    from database import get_db, init_db, Base, SessionLocal
 
 # Environment
 AUTH_MODE = os.getenv("AUTH_MODE", "demo")
-JWT_SECRET = os.getenv("JWT_SECRET", "demo-secret")
 EMBEDDING_MODE = os.getenv("EMBEDDING_MODE", "demo")
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 16))
+EXPORT_PAGE_SIZE = 500
+DEFAULT_TOP_K = int(os.getenv("DEFAULT_TOP_K", 4))
 
 # Database Models
+# 一覧はすべて (所有者, created_at, id) のキーセットで辿るため複合インデックスを張る
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
+    __table_args__ = (Index("ix_chat_sessions_user_created", "user_id", "created_at", "id"),)
     id = Column(Integer, primary_key=True)
-    user_id = Column(String, index=True)
+    user_id = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
+    __table_args__ = (Index("ix_chat_messages_session_created", "session_id", "created_at", "id"),)
     id = Column(Integer, primary_key=True)
-    session_id = Column(Integer, index=True)
+    session_id = Column(Integer)
     role = Column(String)  # user, assistant
     content = Column(Text)
     citations = Column(Text)  # JSON string
@@ -52,24 +73,75 @@ class ChatMessage(Base):
 
 class AuditLog(Base):
     __tablename__ = "audit_logs"
+    __table_args__ = (Index("ix_audit_logs_user_created", "user_id", "created_at", "id"),)
     id = Column(Integer, primary_key=True)
-    user_id = Column(String, index=True)
+    user_id = Column(String)
     action = Column(String)  # ask, bench, login, etc.
     details = Column(Text)  # JSON string
     created_at = Column(DateTime, default=datetime.utcnow)
 
 # Initialize
 rag_system = RAGSystem()
+collection_manager = CollectionManager(rag_system)
+admission = AdmissionController()
+prefetcher = Prefetcher(admission)
+cache_warmer = CacheWarmer(rag_system)
+conversation_store = ConversationStore()
+profiler = SamplingProfiler()
+allocations = AllocationTracker()
 agent = LangGraphAgent(rag_system)
 
+def recent_turns(db: Session, session_id: int) -> List[tuple]:
+    """セッションの直近 SESSION_MAX_TURNS ターンの (質問, 回答)（再起動・LRU追い出し後の履歴復元用）"""
+    messages = (
+        db.query(ChatMessage.role, ChatMessage.content)
+        .filter(ChatMessage.session_id == session_id)
+        .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+        .limit(SESSION_MAX_TURNS * 2)
+        .all()
+    )
+    turns, question = [], None
+    for role, content in reversed(messages):
+        if role == "user":
+            question = content
+        elif question is not None:
+            turns.append((question, content))
+            question = None
+    return turns
+
+def frequent_questions(limit: int, days: int) -> List[str]:
+    """直近days日間のユーザー質問を頻度順に最大limit件"""
+    db = SessionLocal()
+    try:
+        since = datetime.utcnow() - timedelta(days=days)
+        rows = (
+            db.query(ChatMessage.content, func.count(ChatMessage.id).label("n"))
+            .filter(ChatMessage.role == "user", ChatMessage.created_at >= since)
+            .group_by(ChatMessage.content)
+            .order_by(func.count(ChatMessage.id).desc())
+            .limit(limit)
+            .all()
+        )
+        return [row.content for row in rows]
+    finally:
+        db.close()
+
+async def warm_cache():
+    """頻出質問で検索キャッシュを温める（起動後にバックグラウンド実行）"""
+    questions = await asyncio.to_thread(frequent_questions, WARMUP_QUESTIONS, WARMUP_DAYS)
+    # /ask のデフォルト設定と同じキーでキャッシュする
+    await cache_warmer.run(questions, top_k=DEFAULT_TOP_K, use_rerank=True)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     init_db()
     await rag_system.initialize()
+    warmup_task = asyncio.create_task(warm_cache()) if WARMUP_QUESTIONS > 0 else None
     yield
     # Shutdown
-    pass
+    if warmup_task is not None:
+        warmup_task.cancel()
 
 app = FastAPI(
     title="G-RAG API",
@@ -89,13 +161,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Request/Response Models
 class AskRequest(BaseModel):
     question: str
     use_rerank: bool = True
-    top_k: int = 4
+    top_k: int = Field(DEFAULT_TOP_K, ge=1)
+    filters: Optional[Dict[str, List[str]]] = None  # 例: {"doc_id": ["rag_explained"]}
+    collection: Optional[str] = None  # 未指定時は default
+    session_id: Optional[int] = None  # 指定時は同じ会話の続きとして扱う
+
+class BatchAskRequest(BaseModel):
+    questions: List[str]
+    use_rerank: bool = True
+    top_k: int = Field(DEFAULT_TOP_K, ge=1)
+    concurrency: int = 8
+    filters: Optional[Dict[str, List[str]]] = None
+    collection: Optional[str] = None
+
+class PrefetchRequest(BaseModel):
+    question: str  # 入力途中でも可
+    use_rerank: bool = True
+    top_k: int = Field(DEFAULT_TOP_K, ge=1)
+    filters: Optional[Dict[str, List[str]]] = None
+    collection: Optional[str] = None
 
 class Citation(BaseModel):
     id: str
@@ -112,7 +203,8 @@ class BenchRequest(BaseModel):
     questions: List[str]
     runs: int = 3
     use_rerank: bool = True
-    top_k: int = 4
+    top_k: int = Field(DEFAULT_TOP_K, ge=1)
+    collection: Optional[str] = None
 
 class BenchResponse(BaseModel):
     p50_ms: float
@@ -130,6 +222,19 @@ class LoginResponse(BaseModel):
     token: str
     user_id: str
 
+def validate_filters(filters: Optional[Dict[str, List[str]]]):
+    """未対応のフィルタ項目を400で拒否"""
+    unknown = set(filters or {}) - set(FILTER_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unsupported filter fields: {sorted(unknown)}")
+
+async def get_collection(name: Optional[str]) -> RAGSystem:
+    """コレクション取得（存在しない場合は404）"""
+    try:
+        return await collection_manager.get(name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Collection not found: {name}")
+
 # Routes
 @app.post("/auth/login", response_model=LoginResponse)
 async def login(request: LoginRequest, db: Session = Depends(get_db)):
@@ -137,7 +242,7 @@ async def login(request: LoginRequest, db: Session = Depends(get_db)):
     if AUTH_MODE == "demo":
         # DEMO: 任意のパスコードでOK（本番では検証）
         user_id = hashlib.md5(request.passcode.encode()).hexdigest()[:8]
-        token = jwt.encode({"user_id": user_id, "mode": "demo"}, JWT_SECRET, algorithm="HS256")
+        token = create_token({"user_id": user_id, "mode": "demo"})
         
         # 監査ログ
         log = AuditLog(user_id=user_id, action="login", details='{"mode": "demo"}')
@@ -151,22 +256,32 @@ async def login(request: LoginRequest, db: Session = Depends(get_db)):
 @app.post("/ask")
 async def ask(
     request: AskRequest,
-    authorization: Optional[str] = Header(None),
+    user_id: str = Depends(get_current_user_id),
     db: Session = Depends(get_db)
 ):
     """質問に回答（ストリーミング）"""
-    user_id = get_current_user_id(authorization)
+    validate_filters(request.filters)
+    if request.session_id is not None:
+        owned = db.query(ChatSession.id).filter(
+            ChatSession.id == request.session_id, ChatSession.user_id == user_id
+        ).first()
+        if not owned:
+            raise HTTPException(status_code=404, detail="Session not found")
+    rag = await get_collection(request.collection)
+    permit = await admission.acquire(user_id)
     
     async def generate():
         start_time = time.time()
-        session_id = None
+        session_id = request.session_id
         
         try:
-            # セッション作成
-            session = ChatSession(user_id=user_id)
-            db.add(session)
-            db.commit()
-            session_id = session.id
+            # 新しい会話のときのみセッション作成
+            if session_id is None:
+                session = ChatSession(user_id=user_id)
+                db.add(session)
+                db.commit()
+                session_id = session.id
+            conversation = conversation_store.get(session_id, lambda: recent_turns(db, session_id))
             
             # ユーザーメッセージ保存
             msg = ChatMessage(session_id=session_id, role="user", content=request.question)
@@ -178,7 +293,10 @@ async def ask(
             async for chunk in agent.run_stream(
                 question=request.question,
                 use_rerank=request.use_rerank,
-                top_k=request.top_k
+                top_k=request.top_k,
+                filters=request.filters,
+                rag=rag,
+                conversation=conversation
             ):
                 if chunk["type"] == "text":
                     yield f"data: {chunk['data']}\n\n"
@@ -186,6 +304,7 @@ async def ask(
                     result = chunk["data"]
             
             if result:
+                result["metrics"]["session_id"] = session_id
                 # 回答保存
                 import json as json_lib
                 citations_json = json_lib.dumps(result["citations"], ensure_ascii=False)
@@ -218,16 +337,99 @@ async def ask(
         except Exception as e:
             yield f"event: error\n"
             yield f"data: {str(e)}\n\n"
+        finally:
+            permit.release()
+    
+    # ストリーム開始前に切断された場合も background で枠を解放
+    return EventSourceResponse(generate(), background=BackgroundTask(permit.release))
+
+@app.post("/ask/batch")
+async def ask_batch(
+    request: BatchAskRequest,
+    user_id: str = Depends(get_current_user_id),
+    db: Session = Depends(get_db)
+):
+    """一括質問回答（NDJSONストリーミング、完了順に1行1回答）"""
+    validate_filters(request.filters)
+    rag = await get_collection(request.collection)
+    permit = await admission.acquire(user_id)
+    
+    # 同一質問は1回だけ処理し、元の全indexへ展開する
+    positions: Dict[str, List[int]] = {}
+    for index, question in enumerate(request.questions):
+        positions.setdefault(question, []).append(index)
+    unique_questions = list(positions)
+    concurrency = min(max(request.concurrency, 1), BATCH_MAX_CONCURRENCY)
+    
+    async def generate():
+        start_time = time.time()
+        try:
+            async for i, result in agent.run_batch(
+                questions=unique_questions,
+                use_rerank=request.use_rerank,
+                top_k=request.top_k,
+                concurrency=concurrency,
+                filters=request.filters,
+                rag=rag
+            ):
+                question = unique_questions[i]
+                for index in positions[question]:
+                    yield json.dumps({"index": index, "question": question, **result}, ensure_ascii=False) + "\n"
+            
+            # 監査ログ（バッチ単位で1件）
+            elapsed = (time.time() - start_time) * 1000
+            log = AuditLog(
+                user_id=user_id,
+                action="ask_batch",
+                details=json.dumps({
+                    "questions": len(request.questions),
+                    "unique_questions": len(unique_questions),
+                    "elapsed_ms": round(elapsed, 2)
+                })
+            )
+            db.add(log)
+            db.commit()
+        except Exception as e:
+            yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+        finally:
+            permit.release()
     
-    return EventSourceResponse(generate())
+    return StreamingResponse(
+        generate(),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(permit.release)
+    )
+
+@app.post("/prefetch", status_code=202)
+async def prefetch(
+    request: PrefetchRequest,
+    user_id: str = Depends(get_current_user_id)
+):
+    """先読み検索を予約（同一パラメータの後続 /ask は検索を省略して生成へ進む）"""
+    validate_filters(request.filters)
+    rag = await get_collection(request.collection)
+    scheduled = await prefetcher.schedule(
+        user_id,
+        rag,
+        request.question,
+        top_k=request.top_k,
+        use_rerank=request.use_rerank,
+        filters=request.filters
+    )
+    return {"scheduled": scheduled}
+
+@app.delete("/prefetch")
+async def cancel_prefetch(user_id: str = Depends(get_current_user_id)):
+    """未完了の先読みを取り消し"""
+    return {"cancelled": prefetcher.cancel(user_id)}
 
 @app.post("/bench", response_model=BenchResponse)
 async def bench(
     request: BenchRequest,
-    authorization: Optional[str] = Header(None)
+    user_id: str = Depends(get_current_user_id)
 ):
     """ベンチマーク実行"""
-    user_id = get_current_user_id(authorization)
+    rag = await get_collection(request.collection)
     
     times = []
     cache_hits = 0
@@ -239,7 +441,8 @@ async def bench(
             result = await agent.run(
                 question=question,
                 use_rerank=request.use_rerank,
-                top_k=request.top_k
+                top_k=request.top_k,
+                rag=rag
             )
             elapsed = (time.time() - start) * 1000
             times.append(elapsed)
@@ -266,29 +469,47 @@ async def bench(
         est_cost_usd=est_cost
     )
 
+def audit_entry(log: AuditLog) -> Dict[str, Any]:
+    return {
+        "id": log.id,
+        "action": log.action,
+        "details": log.details,
+        "created_at": log.created_at.isoformat()
+    }
+
 @app.get("/history")
 async def get_history(
-    authorization: Optional[str] = Header(None),
-    db: Session = Depends(get_db)
+    response: Response,
+    user_id: str = Depends(get_current_user_id),
+    db: Session = Depends(get_db),
+    limit: int = 50,
+    cursor: Optional[str] = None
 ):
-    """会話履歴一覧"""
-    user_id = get_current_user_id(authorization)
-    sessions = db.query(ChatSession).filter(ChatSession.user_id == user_id).order_by(ChatSession.created_at.desc()).limit(50).all()
+    """会話履歴一覧（新しい順。次ページのカーソルは X-Next-Cursor ヘッダー）"""
+    query = db.query(ChatSession).filter(ChatSession.user_id == user_id)
+    sessions, next_cursor = keyset_page(query, ChatSession, cursor, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return [{"id": s.id, "created_at": s.created_at.isoformat()} for s in sessions]
 
 @app.get("/history/{session_id}")
 async def get_history_detail(
     session_id: int,
-    authorization: Optional[str] = Header(None),
-    db: Session = Depends(get_db)
+    response: Response,
+    user_id: str = Depends(get_current_user_id),
+    db: Session = Depends(get_db),
+    limit: int = 100,
+    cursor: Optional[str] = None
 ):
-    """会話詳細"""
-    user_id = get_current_user_id(authorization)
+    """会話詳細（メッセージは古い順にページング。次ページのカーソルは X-Next-Cursor ヘッダー）"""
     session = db.query(ChatSession).filter(ChatSession.id == session_id, ChatSession.user_id == user_id).first()
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    messages = db.query(ChatMessage).filter(ChatMessage.session_id == session_id).order_by(ChatMessage.created_at).all()
+    query = db.query(ChatMessage).filter(ChatMessage.session_id == session_id)
+    messages, next_cursor = keyset_page(query, ChatMessage, cursor, limit, descending=False)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return {
         "session": {"id": session.id, "created_at": session.created_at.isoformat()},
         "messages": [
@@ -304,22 +525,88 @@ async def get_history_detail(
 
 @app.get("/audit")
 async def get_audit(
-    authorization: Optional[str] = Header(None),
+    response: Response,
+    user_id: str = Depends(get_current_user_id),
     db: Session = Depends(get_db),
-    limit: int = 100
+    limit: int = 100,
+    cursor: Optional[str] = None
 ):
-    """監査ログ"""
-    user_id = get_current_user_id(authorization)
-    logs = db.query(AuditLog).filter(AuditLog.user_id == user_id).order_by(AuditLog.created_at.desc()).limit(limit).all()
-    return [
-        {
-            "id": l.id,
-            "action": l.action,
-            "details": l.details,
-            "created_at": l.created_at.isoformat()
-        }
-        for l in logs
-    ]
+    """監査ログ（新しい順。次ページのカーソルは X-Next-Cursor ヘッダー）"""
+    query = db.query(AuditLog).filter(AuditLog.user_id == user_id)
+    logs, next_cursor = keyset_page(query, AuditLog, cursor, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [audit_entry(l) for l in logs]
+
+@app.get("/audit/export")
+async def export_audit(user_id: str = Depends(get_current_user_id)):
+    """監査ログ全件のエクスポート（NDJSONストリーミング、キーセットで順に読み出し）"""
+    def generate():
+        db = SessionLocal()
+        try:
+            cursor = None
+            while True:
+                query = db.query(AuditLog).filter(AuditLog.user_id == user_id)
+                logs, cursor = keyset_page(query, AuditLog, cursor, EXPORT_PAGE_SIZE)
+                for log in logs:
+                    yield json.dumps(audit_entry(log), ensure_ascii=False) + "\n"
+                # 読み出し済みの行をセッションに溜めない
+                db.expunge_all()
+                if cursor is None:
+                    break
+        finally:
+            db.close()
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+@app.get("/collections")
+async def list_collections(user_id: str = Depends(get_current_user_id)):
+    """コレクション一覧とロード状況"""
+    return {"collections": collection_manager.names(), **collection_manager.stats()}
+
+# 管理用プロファイリング（ADMIN_USER_IDS のユーザーのみ。停止中はオーバーヘッドなし）
+@app.post("/admin/profile", response_class=PlainTextResponse)
+async def admin_profile(
+    seconds: float = 10,
+    interval_ms: float = PROFILE_INTERVAL_MS,
+    user_id: str = Depends(require_admin),
+    db: Session = Depends(get_db)
+):
+    """全スレッドのスタックを seconds 秒間サンプリングし、flamegraph.pl / speedscope で読める collapsed stack を返す"""
+    db.add(AuditLog(user_id=user_id, action="profile", details=json.dumps({"seconds": seconds})))
+    db.commit()
+    return PlainTextResponse(await profiler.profile(seconds, interval_ms))
+
+@app.post("/admin/tracemalloc/start")
+async def admin_tracemalloc_start(frames: int = TRACEMALLOC_FRAMES, user_id: str = Depends(require_admin)):
+    """メモリ割り当ての追跡を開始（現時点を差分の基準にする）"""
+    return allocations.start(frames)
+
+@app.get("/admin/tracemalloc/snapshot")
+async def admin_tracemalloc_snapshot(
+    limit: int = 20,
+    reset: bool = False,
+    user_id: str = Depends(require_admin)
+):
+    """基準からの増加量（cache / documents / rag / sessions / sqlalchemy 別と上位の割り当て行）。reset=true で基準を更新"""
+    return await asyncio.to_thread(allocations.snapshot, limit, reset)
+
+@app.post("/admin/tracemalloc/stop")
+async def admin_tracemalloc_stop(user_id: str = Depends(require_admin)):
+    """追跡を停止"""
+    return allocations.stop()
+
+@app.get("/metrics")
+async def metrics(user_id: str = Depends(get_current_user_id)):
+    """運用メトリクス（キャッシュ・アドミッション制御・先読み・ウォームアップ・会話セッション・コレクション）"""
+    return {
+        "cache": rag_system.cache.info(),
+        "admission": admission.stats(),
+        "prefetch": prefetcher.stats(),
+        "warmup": cache_warmer.status,
+        "sessions": conversation_store.stats(),
+        "collections": collection_manager.stats()
+    }
 
 @app.get("/health")
 async def health():
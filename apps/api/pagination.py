@@ -0,0 +1,49 @@
+"""
+キーセットページネーション（(created_at, id) をカーソルにして OFFSET を使わない）
+"""
+import base64
+from datetime import datetime
+from typing import List, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_page(
+    query,
+    model,
+    cursor: Optional[str],
+    limit: int,
+    descending: bool = True
+) -> Tuple[List, Optional[str]]:
+    """1ページ分の行と次ページのカーソル（最終ページはNone）
+
+    (created_at, id) の複合インデックスを使った範囲検索になるため、ページ位置によらず O(page)。
+    """
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    key = tuple_(model.created_at, model.id)
+    if cursor:
+        position = tuple_(*decode_cursor(cursor))
+        query = query.filter(key < position if descending else key > position)
+    if descending:
+        query = query.order_by(model.created_at.desc(), model.id.desc())
+    else:
+        query = query.order_by(model.created_at.asc(), model.id.asc())
+
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].created_at, rows[-1].id)
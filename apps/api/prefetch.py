@@ -0,0 +1,92 @@
+"""
+先読み検索（入力中の質問で検索キャッシュを温める）
+"""
+import os
+import asyncio
+from typing import Dict, List, Optional
+
+try:
+    from .rag import RAGSystem
+    from .admission import AdmissionController
+except ImportError:
+    from rag import RAGSystem
+    from admission import AdmissionController
+
+PREFETCH_DEBOUNCE_MS = int(os.getenv("PREFETCH_DEBOUNCE_MS", 300))
+PREFETCH_MIN_CHARS = int(os.getenv("PREFETCH_MIN_CHARS", 8))
+
+class Prefetcher:
+    """ユーザーごとに最新の先読みだけをデバウンス後に実行
+
+    新しい先読みが来ると同じユーザーの未完了分は取り消す。/ask が実行枠を使い切っている間は実行しない（低優先度）。
+    """
+    def __init__(self, admission: AdmissionController, debounce_ms: int = PREFETCH_DEBOUNCE_MS):
+        self.admission = admission
+        self.debounce = debounce_ms / 1000
+        self._pending: Dict[str, asyncio.Task] = {}
+        self.counters = {
+            "scheduled": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "skipped_busy": 0,
+            "already_cached": 0
+        }
+
+    async def schedule(
+        self,
+        user_id: str,
+        rag: RAGSystem,
+        question: str,
+        top_k: int = 4,
+        use_rerank: bool = False,
+        filters: Optional[Dict[str, List[str]]] = None
+    ) -> bool:
+        """先読みを予約（短すぎる質問・キャッシュ済みの質問は予約しない）"""
+        self.cancel(user_id)
+        if len(question.strip()) < PREFETCH_MIN_CHARS:
+            return False
+        if await rag.is_cached(question, top_k=top_k, use_rerank=use_rerank, filters=filters):
+            self.counters["already_cached"] += 1
+            return False
+
+        # キャッシュ確認中に同じユーザーの先読みが予約された場合も最新のみ残す
+        self.cancel(user_id)
+        task = asyncio.create_task(self._run(rag, question, top_k, use_rerank, filters))
+        self._pending[user_id] = task
+        task.add_done_callback(lambda t: self._pending.pop(user_id, None) if self._pending.get(user_id) is t else None)
+        self.counters["scheduled"] += 1
+        return True
+
+    def cancel(self, user_id: str) -> bool:
+        """未完了の先読みを取り消し"""
+        task = self._pending.pop(user_id, None)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        self.counters["cancelled"] += 1
+        return True
+
+    async def _run(
+        self,
+        rag: RAGSystem,
+        question: str,
+        top_k: int,
+        use_rerank: bool,
+        filters: Optional[Dict[str, List[str]]]
+    ):
+        await asyncio.sleep(self.debounce)
+        # デバウンス中に /ask 側で検索済みになった場合は何もしない
+        if await rag.is_cached(question, top_k=top_k, use_rerank=use_rerank, filters=filters):
+            self.counters["already_cached"] += 1
+            return
+        if self.admission.active >= self.admission.max_concurrent:
+            self.counters["skipped_busy"] += 1
+            return
+        try:
+            await rag.retrieve(question, top_k=top_k, use_rerank=use_rerank, filters=filters)
+            self.counters["completed"] += 1
+        except Exception as e:
+            print(f"Prefetch failed: {e}")
+
+    def stats(self) -> Dict:
+        return {"pending": len(self._pending), **self.counters}
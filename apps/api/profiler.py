@@ -0,0 +1,141 @@
+"""
+オンデマンドのプロファイリング（スタックサンプリング / tracemalloc によるメモリ増加の追跡）
+
+どちらも要求があったときだけ動作し、停止中はフックもスレッドも存在しないため通常時のオーバーヘッドはない。
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Dict, List, Optional
+from fastapi import HTTPException
+
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 60))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", 25))
+
+# メモリ増加を集計する対象（いずれかのフレームがパターンに一致する割り当て）
+MEMORY_COMPONENTS = {
+    "cache": ("*/cache_backends.py", "*/cachetools/*"),
+    "documents": ("*/chunk_store.py", "*/vector_index.py"),
+    "rag": ("*/rag.py",),
+    "sessions": ("*/conversation.py",),
+    "sqlalchemy": ("*/sqlalchemy/*",),
+}
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    path = code.co_filename.replace("\\", "/").rsplit("/", 2)
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+def _collapse(thread_name: str, frame) -> str:
+    """スレッド名を根とした flamegraph 形式（根;...;葉）のスタック"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ";".join(reversed(labels))
+
+class SamplingProfiler:
+    """全スレッド（イベントループ・ワーカープール含む）のスタックを一定間隔で採取する時間制限付きプロファイラ
+
+    採取は専用スレッドで sys._current_frames() を読むだけで、対象スレッドにフックは入れない。
+    結果は壁時計ベース（待機中のスタックも含む）の collapsed stack 形式。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = False
+        self.last: Dict = {}
+
+    def _sample(self, seconds: float, interval: float) -> Counter:
+        me = threading.get_ident()
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        samples = 0
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    stacks[_collapse(names.get(ident, f"thread-{ident}"), frame)] += 1
+            samples += 1
+            time.sleep(interval)
+        self.last = {"seconds": seconds, "interval_ms": interval * 1000, "samples": samples, "stacks": len(stacks)}
+        return stacks
+
+    async def profile(self, seconds: float, interval_ms: float = PROFILE_INTERVAL_MS) -> str:
+        """seconds 秒間サンプリングし collapsed stack（1行 "根;...;葉 回数"）を返す（同時実行は409）"""
+        if not self._lock.acquire(blocking=False):
+            raise HTTPException(status_code=409, detail="Profiler already running")
+        self.running = True
+        try:
+            seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+            stacks = await asyncio.to_thread(self._sample, seconds, max(interval_ms, 1) / 1000)
+        finally:
+            self.running = False
+            self._lock.release()
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+class AllocationTracker:
+    """tracemalloc の開始時点（または前回リセット時点）からのメモリ増加を集計"""
+    def __init__(self):
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.started_at: Optional[float] = None
+
+    def start(self, frames: int = TRACEMALLOC_FRAMES) -> Dict:
+        if tracemalloc.is_tracing():
+            raise HTTPException(status_code=409, detail="tracemalloc already running")
+        tracemalloc.start(max(frames, 1))
+        self.baseline = tracemalloc.take_snapshot()
+        self.started_at = time.time()
+        return self.status()
+
+    def stop(self) -> Dict:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.baseline = None
+        self.started_at = None
+        return self.status()
+
+    def snapshot(self, limit: int = 20, reset: bool = False) -> Dict:
+        """基準スナップショットとの差分（コンポーネント別の増加量と、増加の大きい行）"""
+        if not tracemalloc.is_tracing() or self.baseline is None:
+            raise HTTPException(status_code=409, detail="tracemalloc not running")
+        current = tracemalloc.take_snapshot()
+        components = {}
+        for name, patterns in MEMORY_COMPONENTS.items():
+            filters = [tracemalloc.Filter(True, pattern, all_frames=True) for pattern in patterns]
+            diff = current.filter_traces(filters).compare_to(self.baseline.filter_traces(filters), "filename")
+            components[name] = {
+                "size_kb": round(sum(d.size for d in diff) / 1024, 1),
+                "size_diff_kb": round(sum(d.size_diff for d in diff) / 1024, 1),
+                "count_diff": sum(d.count_diff for d in diff)
+            }
+
+        # プロファイラ自身と tracemalloc の割り当ては除外
+        excludes = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        top: List[Dict] = []
+        for d in current.filter_traces(excludes).compare_to(self.baseline.filter_traces(excludes), "lineno")[:limit]:
+            frame = d.traceback[0]
+            top.append({
+                "location": f"{frame.filename}:{frame.lineno}",
+                "size_kb": round(d.size / 1024, 1),
+                "size_diff_kb": round(d.size_diff / 1024, 1),
+                "count_diff": d.count_diff
+            })
+        if reset:
+            self.baseline = current
+        return {**self.status(), "components": components, "top": top}
+
+    def status(self) -> Dict:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {
+            "tracing": tracing,
+            "started_at": self.started_at,
+            "traced_kb": round(current / 1024, 1),
+            "peak_kb": round(peak / 1024, 1)
+        }
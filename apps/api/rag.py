@@ -4,63 +4,208 @@ RAGシステム（DEMO/REALモード対応）
 import os
 import hashlib
 import json
+import shutil
+import tempfile
 from typing import List, Dict, Optional, Tuple
 from pathlib import Path
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from cachetools import LRUCache
+
+try:
+    from .vector_index import FlatIndex, build_index, save_vectors, load_vectors
+    from .chunk_store import ChunkStore, ChunkStoreBuilder, ChunkView
+    from .cache_backends import TieredCache, create_far_backend, decode_value
+except ImportError:
+    from vector_index import FlatIndex, build_index, save_vectors, load_vectors
+    from chunk_store import ChunkStore, ChunkStoreBuilder, ChunkView
+    from cache_backends import TieredCache, create_far_backend, decode_value
 
 EMBEDDING_MODE = os.getenv("EMBEDDING_MODE", "demo")
 DATA_DIR = Path(__file__).parent.parent.parent / "data"
+# 埋め込み保存形式: float64 / float32（全精度）、float16 / int8（量子化 + 全精度再スコアリング）
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "float64")
+INDEX_DIR = Path(os.getenv("INDEX_DIR", DATA_DIR / ".index"))
+# 検索フィルタに使えるチャンクのメタデータ項目
+FILTER_FIELDS = ("doc_id", "title")
+# スナップショット形式のバージョン（形式変更時に既存スナップショットを無効化）
+SNAPSHOT_VERSION = 3
+# リランク時の単語一致スコアの重み（ベクトル類似度は 1 - RERANK_WEIGHT）
+RERANK_WEIGHT = 0.3
+# 1位と2位のベクトルスコア差がこれ以上なら、単語一致がどうであってもリランクで1位は入れ替わらない
+SAFE_SKIP_GAP = RERANK_WEIGHT / (1 - RERANK_WEIGHT)
 
 class RAGSystem:
-    def __init__(self):
+    def __init__(
+        self,
+        data_dir: Path = DATA_DIR,
+        index_dir: Path = INDEX_DIR / "default",
+        chunk_size: Optional[int] = None,
+        chunk_overlap: Optional[int] = None,
+        storage: Optional[str] = None
+    ):
+        """chunk_size / chunk_overlap / storage は未指定時に環境変数の値を使う"""
         self.mode = EMBEDDING_MODE
-        self.documents: List[Dict] = []
-        self.embeddings: Optional[np.ndarray] = None
-        self.cache = LRUCache(maxsize=int(os.getenv("CACHE_SIZE", 1000)))
-        self.chunk_size = int(os.getenv("DEFAULT_CHUNK_SIZE", 500))
-        self.chunk_overlap = int(os.getenv("DEFAULT_CHUNK_OVERLAP", 50))
+        self.data_dir = data_dir
+        self.index_dir = index_dir  # スナップショット保存先（index_dir/<fingerprint>/ に文書メタデータ + 正規化済みベクトル）
+        self.documents: Optional[ChunkStore] = None
+        self.storage = storage or EMBEDDING_STORAGE
+        self.index = None
+        self.bitmaps: Dict[str, Dict[str, np.ndarray]] = {}
+        # 近: プロセス内LRU / 遠: CACHE_BACKEND（sqlite/redis）。遠キャッシュの値はこのコーパスの行番号で復元
+        self.cache = TieredCache(
+            maxsize=int(os.getenv("CACHE_SIZE", 1000)),
+            far=create_far_backend(INDEX_DIR / "cache.sqlite"),
+            decode=lambda data: decode_value(data, self.documents)
+        )
+        self.chunk_size = chunk_size or int(os.getenv("DEFAULT_CHUNK_SIZE", 500))
+        self.chunk_overlap = chunk_overlap if chunk_overlap is not None else int(os.getenv("DEFAULT_CHUNK_OVERLAP", 50))
+        self.batch_block_size = int(os.getenv("BATCH_BLOCK_SIZE", 1024))
+        self.oversample = int(os.getenv("QUANTIZATION_OVERSAMPLE", 4))
+        # 適応的検索（既定は無効）: 一次検索のスコア分布でリランク省略・候補の縮小/拡大を決める
+        self.adaptive = os.getenv("ADAPTIVE_RETRIEVAL", "off").lower() in ("on", "true", "1")
+        self.adaptive_gap = float(os.getenv("ADAPTIVE_SCORE_GAP", SAFE_SKIP_GAP))
+        self.adaptive_flat_spread = float(os.getenv("ADAPTIVE_FLAT_SPREAD", 0.02))
+        self.adaptive_widen_factor = int(os.getenv("ADAPTIVE_WIDEN_FACTOR", 4))
     
     async def initialize(self):
-        """初期化: 文書読み込みとベクトル化"""
+        """初期化: 有効なスナップショットがあれば読み込み、なければ文書読み込みとベクトル化"""
         # data/*.md を読み込み
-        md_files = list(DATA_DIR.glob("*.md"))
-        if not md_files:
+        md_files = sorted(self.data_dir.glob("*.md"))
+        if not md_files and self.data_dir == DATA_DIR:
             # サンプル文書を生成
             await self._create_sample_docs()
-            md_files = list(DATA_DIR.glob("*.md"))
+            md_files = sorted(self.data_dir.glob("*.md"))
         
-        chunks = []
+        fingerprint = self._source_fingerprint(md_files)
+        if not self._snapshot_valid(fingerprint):
+            await self._build_snapshot(md_files, fingerprint)
+        self._load_snapshot(fingerprint)
+    
+    def _source_fingerprint(self, md_files: List[Path]) -> str:
+        """元文書とチャンク設定から求めるスナップショットの識別子"""
+        h = hashlib.md5()
+        h.update(f"{SNAPSHOT_VERSION}:{self.mode}:{self.storage}:{self.chunk_size}:{self.chunk_overlap}".encode())
+        for md_file in md_files:
+            stat = md_file.stat()
+            h.update(f"{md_file.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return h.hexdigest()
+    
+    def _snapshot_dir(self, fingerprint: str) -> Path:
+        return self.index_dir / fingerprint
+    
+    def _snapshot_valid(self, fingerprint: str) -> bool:
+        meta_path = self._snapshot_dir(fingerprint) / "meta.json"
+        if not meta_path.exists():
+            return False
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        return meta.get("fingerprint") == fingerprint
+    
+    async def _build_snapshot(self, md_files: List[Path], fingerprint: str):
+        """文書をチャンク化・ベクトル化してスナップショットを保存"""
+        builder = ChunkStoreBuilder()
+        texts = []
+        # 内容ベースの識別子（レプリカ間で共有する遠キャッシュの名前空間）
+        content_hash = hashlib.md5(f"{SNAPSHOT_VERSION}:{self.mode}:{self.storage}:{self.chunk_size}:{self.chunk_overlap}".encode())
         for md_file in md_files:
             with open(md_file, "r", encoding="utf-8") as f:
                 content = f.read()
-                doc_chunks = self._chunk_text(content, md_file.stem)
-                chunks.extend(doc_chunks)
+            content_hash.update(f"{md_file.name}:{content}".encode())
+            doc_id = md_file.stem
+            doc_number = builder.add_document(doc_id, doc_id.replace("_", " ").title())
+            for position, chunk_text in self._chunk_text(content):
+                builder.add_chunk(doc_number, position, chunk_text)
+                texts.append(chunk_text)
         
-        self.documents = chunks
-        
-        # 埋め込み生成
-        texts = [chunk["text"] for chunk in chunks]
-        if self.mode == "demo":
-            self.embeddings = self._demo_embed(texts)
+        # 埋め込み生成（チャンク0件なら (0, dim) の空行列）
+        if self.mode == "demo" or not texts:
+            embeddings = self._demo_embed(texts)
         else:
-            self.embeddings = await self._real_embed(texts)
+            embeddings = await self._real_embed(texts)
+        
+        # 他プロセス（別ワーカー・処理中のリクエスト）が mmap しているファイルを上書きしないよう、
+        # 一時ディレクトリに書き出してから index_dir/<fingerprint>/ へ名前を付け替える
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(prefix=".build-", dir=self.index_dir))
+        try:
+            builder.build().save(staging)
+            save_vectors(staging / "vectors.npy", embeddings, storage=self.storage)
+            (staging / "meta.json").write_text(
+                json.dumps({"fingerprint": fingerprint, "content_id": content_hash.hexdigest()}),
+                encoding="utf-8"
+            )
+            try:
+                os.replace(staging, self._snapshot_dir(fingerprint))
+            except OSError:
+                # 同じスナップショットを別プロセスが先に作成済み（内容は同一）
+                pass
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        self._prune_snapshots(fingerprint)
+    
+    def _prune_snapshots(self, keep: str):
+        """古いスナップショットを削除（unlink のみで切り詰めないため、mmap 中のプロセスは読み続けられる）"""
+        for path in self.index_dir.iterdir():
+            if path.name != keep and (path / "meta.json").exists():
+                shutil.rmtree(path, ignore_errors=True)
     
-    def _chunk_text(self, text: str, doc_id: str) -> List[Dict]:
-        """テキストをチャンクに分割"""
+    def _load_snapshot(self, fingerprint: str):
+        """スナップショットを読み込み（チャンク列・本文・ベクトルは mmap）"""
+        snapshot_dir = self._snapshot_dir(fingerprint)
+        self.documents = ChunkStore.load(snapshot_dir)
+        meta = json.loads((snapshot_dir / "meta.json").read_text(encoding="utf-8"))
+        self.cache.namespace = meta["content_id"]
+        self._build_bitmaps()
+        self.index = build_index(
+            load_vectors(snapshot_dir / "vectors.npy"),
+            storage=self.storage,
+            oversample=self.oversample
+        )
+    
+    def memory_bytes(self) -> int:
+        """常駐メモリの概算（インデックス + チャンクストア）"""
+        index_bytes = self.index.nbytes if self.index is not None else 0
+        store_bytes = self.documents.nbytes if self.documents is not None else 0
+        return index_bytes + store_bytes
+    
+    def _chunk_text(self, text: str) -> List[Tuple[int, str]]:
+        """テキストをチャンクに分割（文書内の単語位置, 本文）"""
         chunks = []
         words = text.split()
         for i in range(0, len(words), self.chunk_size - self.chunk_overlap):
-            chunk_text = " ".join(words[i:i + self.chunk_size])
-            chunks.append({
-                "id": f"{doc_id}_chunk_{i}",
-                "doc_id": doc_id,
-                "text": chunk_text,
-                "title": doc_id.replace("_", " ").title()
-            })
+            chunks.append((i, " ".join(words[i:i + self.chunk_size])))
         return chunks
     
+    def _build_bitmaps(self):
+        """メタデータ値ごとのビットマップインデックスを構築（フィルタ検索用）"""
+        # フィルタ項目はいずれも文書単位のため、文書表から値 → 文書番号を引いてビットマップ化
+        columns = {"doc_id": self.documents.doc_ids, "title": self.documents.titles}
+        self.bitmaps = {}
+        for field in FILTER_FIELDS:
+            postings: Dict[str, List[int]] = {}
+            for doc_number, value in enumerate(columns[field]):
+                postings.setdefault(value, []).append(doc_number)
+            self.bitmaps[field] = {
+                value: np.packbits(self.documents.rows_for_docs(doc_numbers))
+                for value, doc_numbers in postings.items()
+            }
+    
+    def _filter_rows(self, filters: Optional[Dict[str, List[str]]]) -> Optional[np.ndarray]:
+        """フィルタに一致する行番号（項目内はOR、項目間はAND）。フィルタなしはNone"""
+        if not filters:
+            return None
+        n = len(self.documents)
+        matched = None
+        for field, values in filters.items():
+            field_bitmaps = self.bitmaps.get(field)
+            if field_bitmaps is None:
+                raise ValueError(f"Unsupported filter field: {field}")
+            field_mask = np.zeros((n + 7) // 8, dtype=np.uint8)
+            for value in values:
+                bitmap = field_bitmaps.get(value)
+                if bitmap is not None:
+                    field_mask |= bitmap
+            matched = field_mask if matched is None else matched & field_mask
+        return np.flatnonzero(np.unpackbits(matched, count=n))
+    
     def _demo_embed(self, texts: List[str]) -> np.ndarray:
         """DEMO: 簡易ベクトル化（hashベース）"""
         # 各テキストを固定次元ベクトルに変換（簡易版）
@@ -79,7 +224,7 @@ class RAGSystem:
             if norm > 0:
                 vec = vec / norm
             embeddings.append(vec)
-        return np.array(embeddings)
+        return np.array(embeddings).reshape(len(texts), dim)
     
     async def _real_embed(self, texts: List[str]) -> np.ndarray:
         """REAL: OpenAI/Azure OpenAI埋め込み"""
@@ -147,45 +292,224 @@ LangGraph is ideal for building agents, chatbots, and complex reasoning systems
         for filename, content in samples:
             (DATA_DIR / filename).write_text(content.strip(), encoding="utf-8")
     
-    async def retrieve(
+    async def _embed_queries(self, queries: List[str]) -> np.ndarray:
+        """クエリ埋め込み（キャッシュ済みは再利用し、未計算分のみ1回で処理）"""
+        keys = [f"embed:{hashlib.md5(query.encode()).hexdigest()}" for query in queries]
+        vectors = await self.cache.aget_many(keys)
+        misses = [i for i, vec in enumerate(vectors) if vec is None]
+        if misses:
+            texts = [queries[i] for i in misses]
+            if self.mode == "demo":
+                embedded = self._demo_embed(texts)
+            else:
+                embedded = await self._real_embed(texts)
+            for i, vec in zip(misses, embedded):
+                vectors[i] = vec
+            await self.cache.aset_many([(keys[i], vectors[i]) for i in misses])
+        return np.array(vectors)
+    
+    async def is_cached(
         self,
         query: str,
         top_k: int = 4,
-        use_rerank: bool = False
-    ) -> List[Dict]:
-        """検索実行"""
-        cache_key = f"retrieve:{hashlib.md5(query.encode()).hexdigest()}:{top_k}:{use_rerank}"
-        if cache_key in self.cache:
-            return self.cache[cache_key]
-        
-        # クエリ埋め込み
-        if self.mode == "demo":
-            query_vec = self._demo_embed([query])[0]
-        else:
-            query_vec = (await self._real_embed([query]))[0]
-        
-        # 類似度計算
-        similarities = cosine_similarity([query_vec], self.embeddings)[0]
-        top_indices = np.argsort(similarities)[::-1][:top_k * 2]  # リランク用に多めに取得
-        
-        results = []
-        for idx in top_indices:
-            doc = self.documents[idx].copy()
-            doc["score"] = float(similarities[idx])
-            results.append(doc)
+        use_rerank: bool = False,
+        filters: Optional[Dict[str, List[str]]] = None
+    ) -> bool:
+        """検索結果がキャッシュ済みか"""
+        return await self.cache.acontains(self._cache_key(query, top_k, use_rerank, filters))
+    
+    def _cache_key(
+        self,
+        query: str,
+        top_k: int,
+        use_rerank: bool,
+        filters: Optional[Dict[str, List[str]]] = None
+    ) -> str:
+        key = f"retrieve:{hashlib.md5(query.encode()).hexdigest()}:{top_k}:{use_rerank}"
+        if self.adaptive and use_rerank:
+            key += ":adaptive"
+        if filters:
+            canonical = json.dumps({f: sorted(v) for f, v in filters.items()}, sort_keys=True)
+            key += f":{hashlib.md5(canonical.encode()).hexdigest()}"
+        return key
+    
+    def _rank(
+        self,
+        query: str,
+        indices: np.ndarray,
+        scores: np.ndarray,
+        top_k: int,
+        use_rerank: bool
+    ) -> List[ChunkView]:
+        """一次検索の候補から上位チャンクを選択（必要ならリランク）"""
+        results = [self.documents.view(idx, float(score)) for idx, score in zip(indices, scores)]
         
         # リランク（簡易版: スコア再計算）
         if use_rerank and len(results) > top_k:
             # 簡易リランク: クエリとの単語マッチ数を追加スコアに
             query_words = set(query.lower().split())
+            reranked = []
             for doc in results:
-                doc_words = set(doc["text"].lower().split())
+                doc_words = set(doc.text.lower().split())
                 match_ratio = len(query_words & doc_words) / max(len(query_words), 1)
-                doc["score"] = doc["score"] * 0.7 + match_ratio * 0.3
+                reranked.append(doc.with_score(doc.score * (1 - RERANK_WEIGHT) + match_ratio * RERANK_WEIGHT))
             
-            results.sort(key=lambda x: x["score"], reverse=True)
+            results = sorted(reranked, key=lambda x: x.score, reverse=True)
         
-        final_results = results[:top_k]
-        self.cache[cache_key] = final_results
-        return final_results
+        return results[:top_k]
+    
+    def _adapt(
+        self,
+        query_vec: np.ndarray,
+        indices: np.ndarray,
+        scores: np.ndarray,
+        top_k: int,
+        rows: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray, bool, Dict]:
+        """一次検索（降順）のスコア分布からリランクの要否と候補数を決める
 
+        - 1位と2位の差が adaptive_gap 以上: 最上位が明らかなのでリランクしない（skip_rerank。
+          既定の SAFE_SKIP_GAP ならリランクしても1位は変わらない）
+        - 候補全体の差が adaptive_flat_spread 未満: 類似度で区別できないため候補を広げてリランク（widen）
+        - それ以外: リランクしても上位top_kに入り得ない候補を除いてリランク（shrink）
+        戻り値は (候補の行, スコア, リランクするか, 判断内容)
+        """
+        decision = "rerank"
+        gap = float(scores[0] - scores[1]) if len(scores) > 1 else None
+        spread = float(scores[0] - scores[-1]) if len(scores) else 0.0
+        if len(scores) <= top_k:
+            decision = "few_candidates"
+        elif gap is not None and gap >= self.adaptive_gap:
+            decision = "skip_rerank"
+            indices, scores = indices[:top_k], scores[:top_k]
+        else:
+            if spread < self.adaptive_flat_spread and len(scores) == top_k * 2:
+                decision = "widen"
+                wide_indices, wide_scores = self.index.search(query_vec[None, :], top_k * self.adaptive_widen_factor, rows=rows)
+                indices, scores = wide_indices[0], wide_scores[0]
+            # 単語一致が満点でも top_k 位のスコアに届かない候補は除外（スコアは降順）
+            floor = scores[top_k - 1] - SAFE_SKIP_GAP
+            keep = max(top_k, int(np.count_nonzero(scores >= floor)))
+            if keep < len(scores):
+                indices, scores = indices[:keep], scores[:keep]
+                if decision == "rerank":
+                    decision = "shrink"
+        info = {
+            "decision": decision,
+            "gap": round(gap, 4) if gap is not None else None,
+            "spread": round(spread, 4),
+            "candidates": len(scores),
+            "reranked": len(scores) > top_k
+        }
+        return indices, scores, decision != "skip_rerank", info
+    
+    def _select(
+        self,
+        query: str,
+        query_vec: np.ndarray,
+        indices: np.ndarray,
+        scores: np.ndarray,
+        top_k: int,
+        use_rerank: bool,
+        rows: Optional[np.ndarray] = None,
+        trace: Optional[Dict] = None
+    ) -> List[ChunkView]:
+        """一次検索の結果から最終結果を選ぶ（適応的検索が有効ならリランク前に候補を調整）"""
+        if self.adaptive and use_rerank:
+            indices, scores, use_rerank, info = self._adapt(query_vec, indices, scores, top_k, rows)
+            if trace is not None:
+                trace.update(info)
+        return self._rank(query, indices, scores, top_k, use_rerank)
+    
+    async def retrieve(
+        self,
+        query: str,
+        top_k: int = 4,
+        use_rerank: bool = False,
+        filters: Optional[Dict[str, List[str]]] = None,
+        trace: Optional[Dict] = None
+    ) -> List[ChunkView]:
+        """検索実行（filters: {"doc_id": [...], "title": [...]} で対象チャンクを事前に絞り込み）
+
+        trace を渡すと適応的検索の判断内容（decision, gap, spread, candidates, reranked）を書き込む
+        （キャッシュヒット時は判断を再計算しないため decision は cached）。
+        """
+        cache_key = self._cache_key(query, top_k, use_rerank, filters)
+        cached = await self.cache.aget(cache_key)
+        if cached is not None:
+            if trace is not None and self.adaptive and use_rerank:
+                trace["decision"] = "cached"
+            return cached
+        if len(self.documents) == 0 or top_k < 1:
+            return []
+        
+        rows = self._filter_rows(filters)
+        if rows is not None and len(rows) == 0:
+            return []
+        
+        # クエリ埋め込み
+        query_vecs = await self._embed_queries([query])
+        
+        # 類似度計算（リランク用に多めに取得）
+        indices, scores = self.index.search(query_vecs, top_k * 2, rows=rows)
+        
+        final_results = self._select(query, query_vecs[0], indices[0], scores[0], top_k, use_rerank, rows, trace)
+        await self.cache.aset(cache_key, final_results)
+        return final_results
+    
+    async def retrieve_within(
+        self,
+        query: str,
+        rows: np.ndarray,
+        vectors: np.ndarray,
+        top_k: int = 4,
+        use_rerank: bool = False
+    ) -> List[ChunkView]:
+        """指定したチャンク（rows とその正規化済み埋め込み vectors）の中だけで検索"""
+        if top_k < 1 or len(rows) == 0:
+            return []
+        query_vecs = await self._embed_queries([query])
+        positions, scores = FlatIndex(vectors, dtype=np.float32).search(query_vecs, top_k * 2)
+        return self._rank(query, rows[positions[0]], scores[0], top_k, use_rerank)
+    
+    def chunk_vectors(self, docs: List[ChunkView]) -> Tuple[np.ndarray, np.ndarray]:
+        """検索結果チャンクの行番号と正規化済み埋め込み"""
+        rows = np.array([doc.row for doc in docs], dtype=np.int64)
+        return rows, self.index.vectors_for(rows)
+    
+    async def retrieve_batch(
+        self,
+        queries: List[str],
+        top_k: int = 4,
+        use_rerank: bool = False,
+        filters: Optional[Dict[str, List[str]]] = None
+    ) -> List[List[ChunkView]]:
+        """一括検索: 重複排除 → 一括埋め込み → 行列演算で類似度計算"""
+        results: Dict[str, List[ChunkView]] = {}
+        misses = []
+        unique = list(dict.fromkeys(queries))
+        cached_list = await self.cache.aget_many([self._cache_key(q, top_k, use_rerank, filters) for q in unique])
+        for query, cached in zip(unique, cached_list):
+            if cached is not None:
+                results[query] = cached
+            else:
+                misses.append(query)
+        
+        if len(self.documents) == 0 or top_k < 1:
+            return [[] for _ in queries]
+        rows = self._filter_rows(filters)
+        if rows is not None and len(rows) == 0:
+            return [[] for _ in queries]
+        
+        # 類似度行列のメモリを抑えるためブロック単位で計算
+        for start in range(0, len(misses), self.batch_block_size):
+            block = misses[start:start + self.batch_block_size]
+            query_vecs = await self._embed_queries(block)
+            indices, scores = self.index.search(query_vecs, top_k * 2, rows=rows)
+            for query, query_vec, row_indices, row_scores in zip(block, query_vecs, indices, scores):
+                results[query] = self._select(query, query_vec, row_indices, row_scores, top_k, use_rerank, rows)
+            await self.cache.aset_many([
+                (self._cache_key(query, top_k, use_rerank, filters), results[query]) for query in block
+            ])
+        
+        return [results[query] for query in queries]
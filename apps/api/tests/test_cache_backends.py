@@ -0,0 +1,162 @@
+"""
+cache_backends のテスト（Redisバックエンドはローカルの最小RESPサーバーで検証）
+"""
+import sys
+import time
+import socket
+import asyncio
+import threading
+import socketserver
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from cache_backends import RedisBackend, SQLiteBackend, TieredCache, decode_value  # noqa: E402
+
+
+class _RESPHandler(socketserver.StreamRequestHandler):
+    """GET / MGET / SET [EX] / SELECT / AUTH のみ対応"""
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _bulk(self, value):
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def _lookup(self, key):
+        entry = self.server.store.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.server.store[key]
+            return None
+        return value
+
+    def handle(self):
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            cmd = args[0].upper()
+            if cmd == b"GET":
+                reply = self._bulk(self._lookup(args[1]))
+            elif cmd == b"MGET":
+                reply = b"*%d\r\n" % (len(args) - 1) + b"".join(self._bulk(self._lookup(k)) for k in args[1:])
+            elif cmd == b"SET":
+                ttl = int(args[4]) if len(args) >= 5 and args[3].upper() == b"EX" else None
+                self.server.store[args[1]] = (args[2], time.monotonic() + ttl if ttl else None)
+                reply = b"+OK\r\n"
+            elif cmd in (b"SELECT", b"AUTH"):
+                reply = b"+OK\r\n"
+            else:
+                reply = b"-ERR unknown command\r\n"
+            self.wfile.write(reply)
+
+
+class _RESPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _RESPHandler)
+        self.store = {}
+
+
+@pytest.fixture
+def resp_server():
+    server = _RESPServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _url(server) -> str:
+    host, port = server.server_address
+    return f"redis://{host}:{port}/0"
+
+
+def run_async(fn):
+    return asyncio.run(fn())
+
+
+def _closed_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_redis_get_set_roundtrip(resp_server):
+    backend = RedisBackend(_url(resp_server), ttl=60)
+    backend.set("k1", b"\x00binary\r\nvalue")
+    assert backend.get("k1") == b"\x00binary\r\nvalue"
+    assert backend.get("missing") is None
+    assert backend.get_many(["k1", "missing"]) == [b"\x00binary\r\nvalue", None]
+    assert backend.errors == 0
+
+
+def test_redis_set_many_pipelines_set_ex(resp_server):
+    backend = RedisBackend(_url(resp_server), ttl=60)
+    backend.set_many([(f"k{i}", b"v%d" % i) for i in range(50)])
+    assert backend.get_many(["k0", "k49", "k50"]) == [b"v0", b"v49", None]
+    assert resp_server.store[b"k0"][1] is not None
+    assert backend.errors == 0
+
+
+def test_sqlite_set_many_in_one_transaction(tmp_path):
+    backend = SQLiteBackend(tmp_path / "cache.sqlite", ttl=60)
+    backend.set_many([(f"k{i}", b"v%d" % i) for i in range(250)])
+    assert backend.get_many(["k0", "k249", "missing"]) == [b"v0", b"v249", None]
+    assert backend._writes == 250
+
+
+def test_redis_ttl_expires(resp_server):
+    backend = RedisBackend(_url(resp_server), ttl=1)
+    backend.set("short", b"v")
+    assert backend.get("short") == b"v"
+    time.sleep(1.1)
+    assert backend.get("short") is None
+
+
+def test_tiered_cache_shares_values_through_redis(resp_server):
+    decode = lambda data: decode_value(data, None)  # noqa: E731
+    writer = TieredCache(maxsize=10, far=RedisBackend(_url(resp_server)), decode=decode, namespace="ns")
+    reader = TieredCache(maxsize=10, far=RedisBackend(_url(resp_server)), decode=decode, namespace="ns")
+    vec = np.arange(4, dtype=np.float32)
+
+    async def run():
+        await writer.aset("embed:x", vec)
+        await asyncio.gather(*writer._writes)
+        return await reader.aget("embed:x")
+
+    assert np.array_equal(run_async(run), vec)
+    assert reader.stats["far_hits"] == 1
+
+
+def test_tiered_cache_falls_back_to_near_when_connection_fails():
+    far = RedisBackend(f"redis://127.0.0.1:{_closed_port()}/0", timeout_ms=50)
+    cache = TieredCache(maxsize=10, far=far, decode=lambda d: d, namespace="ns")
+    vec = np.ones(3, dtype=np.float32)
+
+    async def run():
+        await cache.aset("embed:a", vec)
+        await asyncio.gather(*cache._writes)
+        return await cache.aget("embed:a"), await cache.aget("embed:b"), await cache.acontains("embed:b")
+
+    hit, miss, contained = run_async(run)
+    assert hit is vec
+    assert miss is None
+    assert contained is False
+    assert far.errors >= 1
+    assert cache.stats["near_hits"] == 1
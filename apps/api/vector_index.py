@@ -0,0 +1,166 @@
+"""
+ベクトルインデックス（全精度 / 量子化 + 全精度再スコアリング）
+"""
+from pathlib import Path
+from typing import Optional, Tuple
+import numpy as np
+
+# 一次スコアリング時の一時バッファを抑えるための行ブロックサイズ
+SCORE_BLOCK_ROWS = 65536
+
+def normalize(vectors: np.ndarray, dtype=np.float32) -> np.ndarray:
+    """行ベクトルをL2正規化（ゼロベクトルはそのまま）"""
+    vectors = np.asarray(vectors, dtype=dtype)
+    if vectors.ndim == 1:
+        # 空配列は (0, 0) 行列として扱う（(1, 0) の1行にしない）
+        vectors = vectors.reshape(1, -1) if vectors.size else vectors.reshape(0, 0)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """各行のスコア上位k件（降順）の (index, score) を返す"""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+class FlatIndex:
+    """全精度ベクトルで全件スコアリング（コサイン類似度）
+
+    正規化済みベクトルを受け取る。dtypeが一致すれば mmap をコピーせずそのまま参照する。
+    """
+    backend = "flat"
+
+    def __init__(self, vectors: np.ndarray, dtype=np.float64):
+        self.vectors = vectors if vectors.dtype == dtype else np.asarray(vectors, dtype=dtype)
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """メモリ常駐バイト数"""
+        return self.vectors.nbytes
+
+    def vectors_for(self, rows: np.ndarray) -> np.ndarray:
+        """指定行の正規化済みベクトル（float32のコピー）"""
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def search(
+        self,
+        query_vecs: np.ndarray,
+        k: int,
+        rows: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """上位k件を検索（rows指定時はその行のみスコアリング）"""
+        queries = normalize(query_vecs, dtype=self.vectors.dtype)
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        indices, scores = _top_k(queries @ vectors.T, k)
+        if rows is not None:
+            indices = rows[indices]
+        return indices, scores
+
+class QuantizedIndex:
+    """圧縮ベクトル（int8/float16）で一次スコアリングし、候補のみ全精度ベクトルで再スコアリング
+
+    全精度ベクトルはディスク上の .npy を mmap で参照するため、常駐するのは圧縮ベクトルのみ。
+    """
+    backend = "quantized"
+
+    def __init__(self, full_vectors: np.ndarray, dtype: str = "int8", oversample: int = 4):
+        self.full = full_vectors  # 正規化済み全精度ベクトル（mmap）
+        self.dtype = dtype
+        self.oversample = max(oversample, 1)
+        if dtype == "int8":
+            self.codes = np.empty(full_vectors.shape, dtype=np.int8)
+            self.scales = np.empty(full_vectors.shape[0], dtype=np.float32)
+        elif dtype == "float16":
+            self.codes = np.empty(full_vectors.shape, dtype=np.float16)
+            self.scales = None
+        else:
+            raise ValueError(f"Unsupported quantization dtype: {dtype}")
+
+        # mmap全体を一度に読み込まないようブロック単位で量子化
+        for start in range(0, full_vectors.shape[0], SCORE_BLOCK_ROWS):
+            block = np.asarray(full_vectors[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+            end = start + block.shape[0]
+            if self.scales is None:
+                self.codes[start:end] = block
+                continue
+            # 行ごとのスケールでスカラー量子化
+            scales = np.abs(block).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self.codes[start:end] = np.round(block / scales[:, None])
+            self.scales[start:end] = scales
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """メモリ常駐バイト数（mmapの全精度ベクトルは含まない）"""
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def vectors_for(self, rows: np.ndarray) -> np.ndarray:
+        """指定行の正規化済み全精度ベクトル（float32のコピー）"""
+        return np.asarray(self.full[rows], dtype=np.float32)
+
+    def _approx_scores(self, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        codes = self.codes if rows is None else self.codes[rows]
+        scores = np.empty((queries.shape[0], codes.shape[0]), dtype=np.float32)
+        for start in range(0, codes.shape[0], SCORE_BLOCK_ROWS):
+            block = codes[start:start + SCORE_BLOCK_ROWS].astype(np.float32)
+            scores[:, start:start + block.shape[0]] = queries @ block.T
+        if self.scales is not None:
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+    def search(
+        self,
+        query_vecs: np.ndarray,
+        k: int,
+        rows: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """上位k件を検索（rows指定時はその行のみスコアリング）"""
+        queries = normalize(query_vecs)
+        candidates, _ = _top_k(self._approx_scores(queries, rows), k * self.oversample)
+        if rows is not None:
+            candidates = rows[candidates]
+
+        # 候補のみ全精度で再スコアリング
+        indices = np.empty((queries.shape[0], min(k, candidates.shape[1])), dtype=np.int64)
+        scores = np.empty(indices.shape, dtype=np.float32)
+        for i, (query, candidate_rows) in enumerate(zip(queries, candidates)):
+            order = np.sort(candidate_rows)  # mmapの読み出しを昇順にする
+            exact = np.asarray(self.full[order]) @ query
+            top, top_scores = _top_k(exact[None, :], k)
+            indices[i] = order[top[0]]
+            scores[i] = top_scores[0]
+        return indices, scores
+
+def full_dtype(storage: str) -> np.dtype:
+    """保存形式に対応する全精度ベクトルのdtype"""
+    return np.dtype(np.float64 if storage == "float64" else np.float32)
+
+def save_vectors(path: Path, vectors: np.ndarray, storage: str = "float64"):
+    """正規化済み全精度ベクトルを .npy へ保存"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(path, normalize(vectors, dtype=full_dtype(storage)))
+
+def load_vectors(path: Path) -> np.ndarray:
+    """保存済みベクトルを mmap で読み込み（実データはアクセス時にページイン）"""
+    return np.load(path, mmap_mode="r")
+
+def build_index(vectors: np.ndarray, storage: str = "float64", oversample: int = 4):
+    """保存形式に応じたインデックスを構築（vectorsは save_vectors で保存した正規化済みベクトル）
+
+    storage: float64 / float32（全精度）、float16 / int8（量子化 + mmap再スコアリング）
+    """
+    if storage in ("float64", "float32"):
+        return FlatIndex(vectors, dtype=np.dtype(storage))
+    return QuantizedIndex(vectors, dtype=storage, oversample=oversample)
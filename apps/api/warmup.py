@@ -0,0 +1,42 @@
+"""
+キャッシュウォームアップ（過去の頻出質問で起動直後の検索キャッシュを温める）
+"""
+import os
+import time
+import asyncio
+from typing import Dict, List
+
+try:
+    from .rag import RAGSystem
+except ImportError:
+    from rag import RAGSystem
+
+WARMUP_QUESTIONS = int(os.getenv("WARMUP_QUESTIONS", 0))  # 0で無効
+WARMUP_DAYS = int(os.getenv("WARMUP_DAYS", 7))
+WARMUP_BATCH_SIZE = int(os.getenv("WARMUP_BATCH_SIZE", 64))
+
+class CacheWarmer:
+    """質問リストをバッチ単位で一括検索し、進捗を保持"""
+    def __init__(self, rag: RAGSystem, batch_size: int = WARMUP_BATCH_SIZE):
+        self.rag = rag
+        self.batch_size = batch_size
+        self.status: Dict = {"state": "disabled", "total": 0, "done": 0}
+
+    async def run(self, questions: List[str], top_k: int = 4, use_rerank: bool = True):
+        start = time.time()
+        self.status = {"state": "running", "total": len(questions), "done": 0}
+        try:
+            for i in range(0, len(questions), self.batch_size):
+                block = questions[i:i + self.batch_size]
+                await self.rag.retrieve_batch(block, top_k=top_k, use_rerank=use_rerank)
+                self.status["done"] += len(block)
+                # リクエスト処理を妨げないようバッチ間でイベントループに譲る
+                await asyncio.sleep(0)
+            self.status["state"] = "completed"
+        except asyncio.CancelledError:
+            self.status["state"] = "cancelled"
+            raise
+        except Exception as e:
+            self.status.update({"state": "failed", "error": str(e)})
+        finally:
+            self.status["elapsed_ms"] = round((time.time() - start) * 1000, 2)
@@ -1,7 +1,11 @@
 'use client'
 
-import { useState } from 'react'
+import { useState, useEffect } from 'react'
 import { Send } from 'lucide-react'
+import { apiRequest } from '@/lib/auth'
+
+// 入力が止まってから先読みを送るまでの待ち時間
+const PREFETCH_DELAY_MS = 300
 
 interface ChatInputProps {
   onSend: (question: string, useRerank: boolean, topK: number) => Promise<void>
@@ -13,6 +17,18 @@ export default function ChatInput({ onSend, loading }: ChatInputProps) {
   const [useRerank, setUseRerank] = useState(true)
   const [topK, setTopK] = useState(4)
 
+  // 入力中の質問で検索を先読み（送信時の検索をキャッシュヒットにする）
+  useEffect(() => {
+    if (!question.trim() || loading) return
+    const timer = setTimeout(() => {
+      apiRequest('/prefetch', {
+        method: 'POST',
+        body: JSON.stringify({ question, use_rerank: useRerank, top_k: topK }),
+      }).catch(() => {})
+    }, PREFETCH_DELAY_MS)
+    return () => clearTimeout(timer)
+  }, [question, useRerank, topK, loading])
+
   const handleSubmit = async (e: React.FormEvent) => {
     e.preventDefault()
     if (!question.trim() || loading) return
@@ -13,6 +13,8 @@ export default function ChatPage() {
   const [citations, setCitations] = useState<any[]>([])
   const [metrics, setMetrics] = useState<any>(null)
   const [loading, setLoading] = useState(false)
+  // 2問目以降は同じ会話セッションとして送信（サーバー側で履歴・取得済みチャンクを再利用）
+  const [sessionId, setSessionId] = useState<number | null>(null)
   const abortControllerRef = useRef<AbortController | null>(null)
 
   const handleSend = async (question: string, useRerank: boolean, topK: number) => {
@@ -39,6 +41,7 @@ export default function ChatPage() {
           question,
           use_rerank: useRerank,
           top_k: topK,
+          ...(sessionId !== null ? { session_id: sessionId } : {}),
         }),
         signal: abortControllerRef.current.signal,
       })
@@ -143,7 +146,9 @@ export default function ChatPage() {
 
           if (ev === 'metrics') {
             try {
-              setMetrics(JSON.parse(data))
+              const parsed = JSON.parse(data)
+              setMetrics(parsed)
+              if (parsed.session_id) setSessionId(parsed.session_id)
             } catch (e) {
               console.error('Failed to parse metrics:', e)
             }
@@ -179,7 +184,9 @@ export default function ChatPage() {
             }
           } else if (ev === 'metrics') {
             try {
-              setMetrics(JSON.parse(data))
+              const parsed = JSON.parse(data)
+              setMetrics(parsed)
+              if (parsed.session_id) setSessionId(parsed.session_id)
             } catch (e) {
               console.error('Failed to parse metrics:', e)
             }
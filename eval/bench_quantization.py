@@ -0,0 +1,62 @@
+"""
+量子化ベンチマーク: メモリ使用量 / recall@k / 検索時間を全精度インデックスと比較
+"""
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "apps" / "api"))
+from vector_index import build_index, save_vectors, load_vectors  # noqa: E402
+
+def make_corpus(n: int, dim: int, clusters: int, seed: int) -> np.ndarray:
+    """クラスタ構造を持つ合成埋め込み（実埋め込みに近い分布）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    labels = rng.integers(0, clusters, size=n)
+    return centers[labels] + rng.normal(scale=0.6, size=(n, dim))
+
+def recall_at_k(truth: np.ndarray, found: np.ndarray) -> float:
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return hits / truth.size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n", type=int, default=50000, help="チャンク数")
+    parser.add_argument("--dim", type=int, default=1536, help="埋め込み次元")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--oversample", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.n, args.dim, clusters=max(args.n // 100, 1), seed=args.seed)
+    rng = np.random.default_rng(args.seed + 1)
+    queries = corpus[rng.integers(0, args.n, size=args.queries)] + rng.normal(scale=0.3, size=(args.queries, args.dim))
+
+    print(f"n={args.n} dim={args.dim} queries={args.queries} k={args.k} oversample={args.oversample}\n")
+    print("| 保存形式 | 常駐メモリ(MB) | 圧縮率 | recall@k | 検索時間/クエリ(ms) |")
+    print("|----------|---------------|--------|----------|--------------------|")
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = None
+        for storage in ["float64", "float32", "float16", "int8"]:
+            path = Path(tmp) / f"{storage}.npy"
+            save_vectors(path, corpus, storage=storage)
+            index = build_index(load_vectors(path), storage=storage, oversample=args.oversample)
+            if baseline is None:
+                # float64を正解として recall を計算
+                baseline = index
+                truth, _ = baseline.search(queries, args.k)
+            start = time.perf_counter()
+            found, _ = index.search(queries, args.k)
+            elapsed = (time.perf_counter() - start) * 1000 / args.queries
+            print(
+                f"| {storage} | {index.nbytes / 1e6:.1f} | {baseline.nbytes / index.nbytes:.1f}x "
+                f"| {recall_at_k(truth, found):.4f} | {elapsed:.2f} |"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+検索品質 × 速度スイープ: chunk_size / overlap / top_k / rerank / 適応的検索 / インデックス形式のグリッドを
+プロセス内で評価し、recall@k・MRR・構築時間・メモリ・検索時間とパレート最適な設定を出力
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import tempfile
+import csv
+from pathlib import Path
+from typing import List, Dict, Any
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "apps" / "api"))
+from rag import RAGSystem, DATA_DIR  # noqa: E402
+
+def parse_list(value: str, cast=str) -> List:
+    return [cast(v) for v in value.split(",") if v]
+
+def parse_bool(value: str) -> bool:
+    return value.lower() in ("on", "true", "1")
+
+def load_questions() -> List[Dict[str, Any]]:
+    """expected_docs（正解文書ID）付きの質問のみ使用"""
+    questions = []
+    with open(Path(__file__).parent / "questions.jsonl", "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                if item.get("expected_docs"):
+                    questions.append(item)
+    return questions
+
+def score(results, expected: List[str]) -> Dict[str, float]:
+    """文書単位の recall@k と MRR"""
+    doc_ids = [doc.doc_id for doc in results]
+    recall = len(set(doc_ids) & set(expected)) / len(expected)
+    rr = next((1.0 / (rank + 1) for rank, doc_id in enumerate(doc_ids) if doc_id in expected), 0.0)
+    return {"recall": recall, "rr": rr}
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0.0
+
+def pareto_front(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """recall@k・MRR（高いほど良い）と p50検索時間（低いほど良い）で他に支配されない設定"""
+    def dominates(a, b):
+        better_or_equal = a["recall_at_k"] >= b["recall_at_k"] and a["mrr"] >= b["mrr"] and a["p50_ms"] <= b["p50_ms"]
+        strictly = a["recall_at_k"] > b["recall_at_k"] or a["mrr"] > b["mrr"] or a["p50_ms"] < b["p50_ms"]
+        return better_or_equal and strictly
+    return [r for r in rows if not any(dominates(o, r) for o in rows if o is not r)]
+
+async def run_sweep(args) -> List[Dict[str, Any]]:
+    questions = load_questions()
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for chunk_size, overlap, backend in itertools.product(args.chunk_sizes, args.overlaps, args.backends):
+            if overlap >= chunk_size:
+                continue
+            rag = RAGSystem(
+                data_dir=args.data_dir,
+                index_dir=Path(tmp) / f"{chunk_size}_{overlap}_{backend}",
+                chunk_size=chunk_size,
+                chunk_overlap=overlap,
+                storage=backend
+            )
+            # clear() は近キャッシュのみ消すため、遠キャッシュ（CACHE_BACKEND=sqlite/redis）は使わない
+            rag.cache.far = None
+            start = time.perf_counter()
+            await rag.initialize()
+            build_ms = (time.perf_counter() - start) * 1000
+
+            for top_k, use_rerank, adaptive in itertools.product(args.top_ks, args.rerank, args.adaptive):
+                if adaptive and not use_rerank:
+                    continue  # 適応的検索はリランク有効時のみ作用
+                rag.adaptive = adaptive
+                times, recalls, rrs = [], [], []
+                for item in questions:
+                    for _ in range(args.repeats):
+                        rag.cache.clear()  # キャッシュなしの検索時間を計測
+                        start = time.perf_counter()
+                        results = await rag.retrieve(item["question"], top_k=top_k, use_rerank=use_rerank)
+                        times.append((time.perf_counter() - start) * 1000)
+                    s = score(results, item["expected_docs"])
+                    recalls.append(s["recall"])
+                    rrs.append(s["rr"])
+                row = {
+                    "chunk_size": chunk_size,
+                    "chunk_overlap": overlap,
+                    "backend": backend,
+                    "top_k": top_k,
+                    "rerank": use_rerank,
+                    "adaptive": adaptive,
+                    "chunks": len(rag.documents),
+                    "recall_at_k": sum(recalls) / len(recalls),
+                    "mrr": sum(rrs) / len(rrs),
+                    "build_ms": build_ms,
+                    "memory_bytes": rag.memory_bytes(),
+                    "p50_ms": percentile(times, 0.5),
+                    "p95_ms": percentile(times, 0.95)
+                }
+                rows.append(row)
+                print(
+                    f"  chunk={chunk_size}/{overlap} {backend} top_k={top_k} rerank={'on' if use_rerank else 'off'} "
+                    f"adaptive={'on' if adaptive else 'off'}: "
+                    f"recall={row['recall_at_k']:.3f} mrr={row['mrr']:.3f} p50={row['p50_ms']:.2f}ms"
+                )
+    return rows
+
+def write_reports(rows: List[Dict[str, Any]], out_dir: Path):
+    front = pareto_front(rows)
+    for row in rows:
+        row["pareto"] = row in front
+
+    csv_file = out_dir / "sweep_results.csv"
+    with open(csv_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    md_file = out_dir / "sweep_results.md"
+    header = "| chunk | overlap | backend | top_k | rerank | adaptive | recall@k | MRR | p50(ms) | p95(ms) | 構築(ms) | メモリ(KB) |\n"
+    header += "|-------|---------|---------|-------|--------|----------|----------|-----|---------|---------|----------|-----------|\n"
+
+    def line(r):
+        return (
+            f"| {r['chunk_size']} | {r['chunk_overlap']} | {r['backend']} | {r['top_k']} | {'on' if r['rerank'] else 'off'} "
+            f"| {'on' if r['adaptive'] else 'off'} | {r['recall_at_k']:.3f} | {r['mrr']:.3f} | {r['p50_ms']:.2f} | {r['p95_ms']:.2f} "
+            f"| {r['build_ms']:.0f} | {r['memory_bytes'] / 1024:.1f} |\n"
+        )
+
+    with open(md_file, "w", encoding="utf-8") as f:
+        f.write("# スイープ結果\n\n")
+        f.write("## パレート最適な設定（recall@k・MRR ↑ / p50 ↓）\n\n")
+        f.write(header)
+        for r in sorted(front, key=lambda r: r["p50_ms"]):
+            f.write(line(r))
+        f.write("\n## 全設定\n\n")
+        f.write(header)
+        for r in rows:
+            f.write(line(r))
+
+    print(f"\n完了: {csv_file}, {md_file}（パレート最適 {len(front)}/{len(rows)} 設定）")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunk-sizes", type=lambda v: parse_list(v, int), default=[100, 200, 500])
+    parser.add_argument("--overlaps", type=lambda v: parse_list(v, int), default=[0, 50])
+    parser.add_argument("--top-ks", type=lambda v: parse_list(v, int), default=[2, 4, 8])
+    parser.add_argument("--rerank", type=lambda v: parse_list(v, parse_bool), default=[False, True], help="例: off,on")
+    parser.add_argument("--adaptive", type=lambda v: parse_list(v, parse_bool), default=[False, True], help="例: off,on")
+    parser.add_argument("--backends", type=lambda v: parse_list(v), default=["float64", "float32", "float16", "int8"])
+    parser.add_argument("--repeats", type=int, default=3, help="1質問あたりの計測回数")
+    parser.add_argument("--data-dir", type=Path, default=DATA_DIR)
+    parser.add_argument("--out-dir", type=Path, default=Path(__file__).parent, help="結果の出力先（既定の eval/sweep_results.* はgit管理外）")
+    args = parser.parse_args()
+
+    rows = asyncio.run(run_sweep(args))
+    if rows:
+        args.out_dir.mkdir(parents=True, exist_ok=True)
+        write_reports(rows, args.out_dir)
+
+if __name__ == "__main__":
+    main()